@@ -1,37 +1,149 @@
-from flask import Flask, render_template, request
+from flask import Flask, Blueprint, current_app, render_template, request, abort, g, make_response, jsonify, Response, \
+    send_from_directory, stream_template, stream_with_context
+from flask.cli import AppGroup
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
 
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import bindparam, event, inspect, select, text
+from sqlalchemy.exc import IntegrityError
 
 from flask_wtf import FlaskForm
-from wtforms import StringField, RadioField, validators
+from wtforms import StringField, RadioField, HiddenField, IntegerField, ValidationError, validators
+from werkzeug.local import LocalProxy
+from werkzeug.middleware.proxy_fix import ProxyFix
 
-import json
+import click
 
-from random import shuffle
+import gc
+import hashlib
+import json
+import math
+import os
+import threading
+import uuid
+from collections import Counter, namedtuple
+import time as clock
+from functools import wraps
+from urllib.parse import urlencode
 
-with open('goals.json', encoding='utf-8') as g:
-    all_goals = json.load(g)
+import assets
+import availability
+import compress
+import database
+import jsonstream
+from search import SearchIndex
+from cache import LocalBackend, LRUCache, PageCache, SQLiteBackend
+from intake import MemoryStore, RateLimiter, SQLiteStore, normalize_phone
+from profiling import Profiler
+from jobs import JobQueue
+from startup import StartupReport
 
-with open('teachers.json', encoding='utf-8') as t:
-    teachers = json.load(t)
+from datetime import datetime
+from random import sample
 
 links = [{'title': 'Все репетиторы', 'link': '/'}, {'title': 'Заявка на подбор', 'link': '/request'}]
 days = {'mon': 'Понедельник', 'tue': 'Вторник', 'wed': 'Среда', 'thu': 'Четверг', 'fri': 'Пятница'}
 times = {'8': '8:00', '10': '10:00', '12': '12:00', '14': '14:00', '16': '16:00'}
 
 
-app = Flask(__name__)
+# Application
+# Importing this module and create_app() do not touch the database, the caches or the catalog: everything is set up on
+# first use, so creating the app takes milliseconds at any catalog size and can be done once in a gunicorn master
+# before it forks (see wsgi.py). Routes and CLI commands are on the site blueprint.
+def configure(app):
+    app.secret_key = 'some-very-secret-key'
+
+    # Page cache settings: PAGE_CACHE is 'local' (an LRU in every worker), 'sqlite' (one file shared by all workers
+    # on the host, so a page rendered by one worker is served by all) or 'off'. Invalidations reach every worker either
+    # way (see "Page cache"). Either backend keeps at most PAGE_CACHE_SIZE pages.
+    app.config['PAGE_CACHE'] = os.environ.get('PAGE_CACHE', 'local')
+    app.config['PAGE_CACHE_SIZE'] = 1000
+    app.config['PAGE_CACHE_TTL'] = 300
+    app.config['PAGE_CACHE_PATH'] = 'page_cache.db'
+    # Rendered teacher cards and schedules kept per worker (see "Fragment cache" below).
+    app.config['FRAGMENT_CACHE_SIZE'] = 10000
+
+    # Compiled templates are kept on disk, so a new worker loads them instead of compiling every template again.
+    # An empty TEMPLATE_BYTECODE_CACHE turns this off.
+    app.config['TEMPLATE_BYTECODE_CACHE'] = os.environ.get('TEMPLATE_BYTECODE_CACHE',
+                                                           os.path.join(app.root_path, '.jinja_cache'))
+
+    # Lead form throttling (see intake.py): INTAKE_STORE is 'memory' (buckets per worker), 'sqlite' (one file shared
+    # by all workers on the host) or 'off'. Every IP may send INTAKE_IP_BURST forms at once and INTAKE_IP_PER_MINUTE
+    # more a minute after that; the same for every phone number.
+    app.config['INTAKE_STORE'] = os.environ.get('INTAKE_STORE', 'memory')
+    app.config['INTAKE_STORE_PATH'] = 'intake.db'
+    app.config['INTAKE_IP_BURST'] = 10
+    app.config['INTAKE_IP_PER_MINUTE'] = 2
+    app.config['INTAKE_PHONE_BURST'] = 3
+    app.config['INTAKE_PHONE_PER_MINUTE'] = 0.2
+    # Number of proxies in front of the app whose X-Forwarded-For is trusted for the client IP. Heroku (which sets DYNO)
+    # has its router in front: without it every visitor would share the router's IP and its intake buckets.
+    app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 1 if 'DYNO' in os.environ else 0))
+
+    # Responses are compressed by the app (see compress.py): nothing in front of it does on Heroku. COMPRESSION=off
+    # leaves it to a proxy. Bodies shorter than COMPRESSION_MIN_SIZE bytes are sent as they are.
+    app.config['COMPRESSION'] = os.environ.get('COMPRESSION', 'on') != 'off'
+    app.config['COMPRESSION_MIN_SIZE'] = 1024
+
+    # Per-request SQL and render timings, /metrics and the slow request log (see profiling.py); off unless PROFILING=1.
+    app.config['PROFILING'] = os.environ.get('PROFILING') == '1'
+    app.config['PROFILING_SLOW_MS'] = int(os.environ.get('PROFILING_SLOW_MS', 500))
+
+
+def create_app(config=None):
+    app = Flask(__name__)
+    configure(app)
+    app.config.update(config or {})
+    # Engine and pool settings come from APP_ENV and environment variables (see database.py), unless config has them.
+    database.configure(app)
+
+    if app.config['TEMPLATE_BYTECODE_CACHE']:
+        os.makedirs(app.config['TEMPLATE_BYTECODE_CACHE'], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['TEMPLATE_BYTECODE_CACHE'])
+
+    if app.config['TRUSTED_PROXIES']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'])
+
+    db.init_app(app)
+    init_page_cache(app)
+    init_intake(app)
+    init_assets(app)
+    init_compression(app)
+    app.extensions['fragment_cache'] = LRUCache(app.config['FRAGMENT_CACHE_SIZE'])
+    if app.config['PROFILING']:
+        Profiler(app)
+    StartupReport(app)
+    app.register_blueprint(site)
+    return app
+
+
+def warm_up(app):
+    # Work a worker would otherwise do on its first requests, done once before forking (gunicorn --preload, see wsgi.py):
+    # templates are compiled and the catalog snapshot and the slot index are built, and the forked workers share them.
+    # The connections this opens are dropped by every worker after the fork (database.Database.after_fork).
+    with app.app_context():
+        for template_name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(template_name)
+        get_catalog()
+        get_slot_index()
+        db.session.remove()
+    # Everything made so far lives as long as the process: the collector of a worker leaves it alone instead of
+    # walking it, which would copy its pages into every worker.
+    gc.freeze()
 
-app.secret_key = 'some-very-secret-key'
 
 # Database section
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///tinysteps.db'
-db = SQLAlchemy(app)
+db = database.Database()
+site = Blueprint('site', __name__, cli_group=None)
 
 # Database - Models
+# (teacher_id, goal_id) is unique, and goal pages look teachers up by goal_id, so both directions are indexed.
 teachers_goals = db.Table('teachers_goals',
-                                      db.Column('teacher_id', db.Integer, db.ForeignKey('db_teachers.id')),
-                                      db.Column('goal_id', db.Integer, db.ForeignKey('db_goals.id')))
+                                      db.Column('teacher_id', db.Integer, db.ForeignKey('db_teachers.id'), nullable=False),
+                                      db.Column('goal_id', db.Integer, db.ForeignKey('db_goals.id'), nullable=False),
+                                      db.Index('ix_teachers_goals_teacher_goal', 'teacher_id', 'goal_id', unique=True),
+                                      db.Index('ix_teachers_goals_goal_teacher', 'goal_id', 'teacher_id'))
 
 
 class Goal(db.Model):
@@ -53,9 +165,25 @@ class Teacher(db.Model):
     goals = db.relationship('Goal',
                             secondary=teachers_goals,
                             back_populates='teachers')
+    # free is the schedule as it came from teachers.json, free_mask is the same schedule packed by availability.pack_free().
+    # The app only reads free_mask.
     free = db.Column(db.String, nullable=False)
+    # 56 bits: BIGINT, which SQLite's INTEGER is anyway.
+    free_mask = db.Column(db.BigInteger)
     bookings = db.relationship('Booking',
                                back_populates='teacher')
+    # Bumped on every change of the row; rendered fragments of the teacher are keyed by it.
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    # teacher_hash() of the teachers.json record the row was written from; NULL for rows older than the column.
+    content_hash = db.Column(db.String)
+    # Goal pages are sorted by rating or price with id as a tie-breaker (keyset pagination).
+    __table_args__ = (db.Index('ix_teachers_rating_id', 'rating', 'id'),
+                      db.Index('ix_teachers_price_id', 'price', 'id'))
+
+@event.listens_for(Teacher, 'before_update')
+def bump_teacher_version(mapper, connection, teacher):
+    # Evaluated by the database, so two concurrent updates both count.
+    teacher.version = Teacher.version + 1
 
 class Booking(db.Model):
     __tablename__ = 'db_bookings'
@@ -66,47 +194,1319 @@ class Booking(db.Model):
     time = db.Column(db.String)
     name = db.Column(db.String)
     phone = db.Column(db.String)
+    # day and time are keys of days and times; one booking per teacher slot.
+    __table_args__ = (db.Index('ix_bookings_teacher_slot', 'teacher_id', 'day', 'time', unique=True),)
+
+class Lead(db.Model):
+    # Every booking, message and pick request, with the phone normalized (intake.normalize_phone).
+    __tablename__ = 'db_leads'
+    id = db.Column(db.Integer, primary_key=True)
+    # booking, message or request
+    kind = db.Column(db.String, nullable=False)
+    teacher_id = db.Column(db.Integer, db.ForeignKey('db_teachers.id'))
+    name = db.Column(db.String, nullable=False)
+    phone = db.Column(db.String, nullable=False)
+    # What the lead is about (see lead_subject()); the same phone cannot leave the same lead twice.
+    subject = db.Column(db.String, nullable=False)
+    # From the form's hidden field: a resubmitted form (double click, reload, retry) carries the same key.
+    idempotency_key = db.Column(db.String)
+    created_at = db.Column(db.Float, nullable=False)
+    __table_args__ = (db.Index('ix_leads_dedup', 'kind', 'phone', 'subject', unique=True),
+                      db.Index('ix_leads_idempotency_key', 'idempotency_key', unique=True))
+
+class Review(db.Model):
+    # Left by someone who has booked the teacher, with the phone of the booking; one per phone and teacher.
+    __tablename__ = 'db_reviews'
+    id = db.Column(db.Integer, primary_key=True)
+    teacher_id = db.Column(db.Integer, db.ForeignKey('db_teachers.id'), nullable=False)
+    name = db.Column(db.String, nullable=False)
+    phone = db.Column(db.String, nullable=False)
+    # 1 to 5
+    rating = db.Column(db.Integer, nullable=False)
+    text = db.Column(db.String)
+    created_at = db.Column(db.Float, nullable=False)
+    __table_args__ = (db.Index('ix_reviews_teacher_phone', 'teacher_id', 'phone', unique=True),)
+
+class CacheTag(db.Model):
+    # Page cache tag versions (see "Page cache"), one row per tag ever invalidated.
+    __tablename__ = 'db_cache_tags'
+    tag = db.Column(db.String, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+class CatalogVersion(db.Model):
+    # One row, bumped by every change of goals, teachers or reviews (see "Catalog snapshot").
+    __tablename__ = 'db_catalog'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+# Running sums and counts, changed in the same transaction as the rows they count (see "Database - Aggregates"),
+# so pages read them by primary key instead of aggregating reviews and teachers.
+class TeacherStats(db.Model):
+    __tablename__ = 'db_teacher_stats'
+    teacher_id = db.Column(db.Integer, db.ForeignKey('db_teachers.id'), primary_key=True)
+    review_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Float, nullable=False, default=0)
+
+class GoalStats(db.Model):
+    __tablename__ = 'db_goal_stats'
+    goal_id = db.Column(db.Integer, db.ForeignKey('db_goals.id'), primary_key=True)
+    teacher_count = db.Column(db.Integer, nullable=False, default=0)
+    price_sum = db.Column(db.Float, nullable=False, default=0)
+    # Reviews of the goal's teachers.
+    review_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Float, nullable=False, default=0)
+
+class Job(db.Model):
+    # Outbox of background jobs (see jobs.py); times are unix timestamps.
+    __tablename__ = 'db_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String, nullable=False)
+    payload = db.Column(db.String, nullable=False)
+    # pending -> running -> done, or back to pending until the attempts run out, then failed.
+    status = db.Column(db.String, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False)
+    run_at = db.Column(db.Float, nullable=False)
+    claim_token = db.Column(db.String)
+    locked_at = db.Column(db.Float)
+    last_error = db.Column(db.String)
+    created_at = db.Column(db.Float, nullable=False)
+    # Workers look for due jobs by status and run_at.
+    __table_args__ = (db.Index('ix_jobs_status_run_at', 'status', 'run_at'),)
+
+
+# Database - Migrations
+def migrate_free_masks():
+    # Databases made before free_mask existed get the column, then every row without a mask gets one from its free string.
+    columns = [column['name'] for column in inspect(db.engine).get_columns('db_teachers')]
+    if 'free_mask' not in columns:
+        db.session.execute(text('ALTER TABLE db_teachers ADD COLUMN free_mask BIGINT'))
+    rows = db.session.query(Teacher.id, Teacher.free).filter(Teacher.free_mask.is_(None)).all()
+    db.session.bulk_update_mappings(Teacher, [{'id': id, 'free_mask': availability.pack_free(availability.parse_free(free))}
+                                              for id, free in rows])
+    db.session.commit()
+
+
+def migrate_versions():
+    columns = [column['name'] for column in inspect(db.engine).get_columns('db_teachers')]
+    if 'version' not in columns:
+        db.session.execute(text('ALTER TABLE db_teachers ADD COLUMN version INTEGER NOT NULL DEFAULT 1'))
+        db.session.commit()
+
+
+def migrate_content_hashes():
+    # Rows without a hash are rewritten once by the next "flask import".
+    columns = [column['name'] for column in inspect(db.engine).get_columns('db_teachers')]
+    if 'content_hash' not in columns:
+        db.session.execute(text('ALTER TABLE db_teachers ADD COLUMN content_hash VARCHAR'))
+        db.session.commit()
+
+
+def create_schema():
+    db.create_all()
+    search_index.create(db.session.connection())
+    migrate_free_masks()
+    migrate_versions()
+    migrate_content_hashes()
+    if db.session.query(CatalogVersion).get(1) is None:
+        db.session.add(CatalogVersion(id=1, version=1))
+        db.session.commit()
+    migrate_stats()
+    # create_all() only creates indexes together with new tables, so databases made before the indexes existed get them here.
+    for index in list(teachers_goals.indexes) + list(Teacher.__table__.indexes) + list(Booking.__table__.indexes):
+        index.create(db.engine, checkfirst=True)
+    # Databases filled before the search index existed (or seeded when it was not filled by seeding) get it filled once;
+    # otherwise the empty FTS5 table would answer every search with nothing.
+    connection = db.session.connection()
+    if search_index.is_empty(connection) and db.session.query(Teacher.id).first() is not None:
+        search_index.rebuild(connection, teacher_documents(connection))
+    db.session.commit()
+
+
+def migrate_stats():
+    # Databases made before the aggregates existed get them built once.
+    if db.session.query(TeacherStats).count() != db.session.query(Teacher).count() \
+            or db.session.query(GoalStats).count() != db.session.query(Goal).count():
+        reconcile_stats()
+
+
+# Database - Aggregates
+# A teacher's rating is the average of the reviews once there are any (until then the one from teachers.json);
+# goal pages show the number of teachers, the average price and the average review of the goal. Writes adjust
+# db_teacher_stats and db_goal_stats by the difference they make; reconcile_stats() ("flask reconcile-stats")
+# rebuilds both from scratch in a few statements.
+def average_rating(stats):
+    # Numeric, because PostgreSQL only rounds numerics to a number of digits.
+    return db.func.round(db.cast(stats.c.rating_sum / stats.c.review_count, db.Numeric), 1)
 
-db.create_all()
+
+def adjust_goal_stats(deltas):
+    # deltas: {goal_id: (teachers, price sum, reviews, rating sum)} to add; a teacher leaving a goal is
+    # (-1, -price, -its reviews, -its rating sum).
+    deltas = {goal_id: delta for goal_id, delta in deltas.items() if any(delta)}
+    if not deltas:
+        return
+    stats = GoalStats.__table__
+    db.session.execute(stats.update()
+                       .where(stats.c.goal_id == bindparam('b_goal_id'))
+                       .values(teacher_count=stats.c.teacher_count + bindparam('b_teachers'),
+                               price_sum=stats.c.price_sum + bindparam('b_prices'),
+                               review_count=stats.c.review_count + bindparam('b_reviews'),
+                               rating_sum=stats.c.rating_sum + bindparam('b_ratings')),
+                       [{'b_goal_id': goal_id, 'b_teachers': teachers, 'b_prices': prices, 'b_reviews': reviews,
+                         'b_ratings': ratings}
+                        for goal_id, (teachers, prices, reviews, ratings) in deltas.items()])
+
+
+def add_goal_delta(deltas, goal_id, *delta):
+    deltas[goal_id] = tuple(total + change for total, change in zip(deltas.get(goal_id, (0, 0, 0, 0)), delta))
+
+
+def add_review(teacher_id, name, phone, rating, text):
+    # IntegrityError (ix_reviews_teacher_phone) is raised here, before any aggregate is touched.
+    db.session.add(Review(teacher_id=teacher_id, name=name, phone=phone, rating=rating, text=text or None,
+                          created_at=clock.time()))
+    db.session.flush()
+    teacher_stats = TeacherStats.__table__
+    db.session.execute(teacher_stats.update()
+                       .where(teacher_stats.c.teacher_id == teacher_id)
+                       .values(review_count=teacher_stats.c.review_count + 1,
+                               rating_sum=teacher_stats.c.rating_sum + rating))
+    goal_stats = GoalStats.__table__
+    db.session.execute(goal_stats.update()
+                       .where(goal_stats.c.goal_id.in_(select([teachers_goals.c.goal_id])
+                                                       .where(teachers_goals.c.teacher_id == teacher_id)))
+                       .values(review_count=goal_stats.c.review_count + 1,
+                               rating_sum=goal_stats.c.rating_sum + rating))
+    # The rating column is what cards show and goal pages sort by, so it follows the reviews.
+    db.session.query(Teacher)\
+        .filter(Teacher.id == teacher_id)\
+        .update({Teacher.rating: select([average_rating(teacher_stats)])
+                .where(teacher_stats.c.teacher_id == teacher_id).scalar_subquery(),
+                 Teacher.version: Teacher.version + 1},
+                synchronize_session=False)
+
+
+def reconcile_stats():
+    # Returns the number of teachers whose rating changed.
+    teachers = Teacher.__table__
+    reviews = Review.__table__
+    teacher_stats = TeacherStats.__table__
+    goal_stats = GoalStats.__table__
+    connection = db.session.connection()
+
+    connection.execute(teacher_stats.delete())
+    connection.execute(teacher_stats.insert().from_select(
+        ['teacher_id', 'review_count', 'rating_sum'],
+        select([teachers.c.id, db.func.count(reviews.c.id), db.func.coalesce(db.func.sum(reviews.c.rating), 0)])
+        .select_from(teachers.outerjoin(reviews, reviews.c.teacher_id == teachers.c.id))
+        .group_by(teachers.c.id)))
+
+    goals = Goal.__table__
+    connection.execute(goal_stats.delete())
+    connection.execute(goal_stats.insert().from_select(
+        ['goal_id', 'teacher_count', 'price_sum', 'review_count', 'rating_sum'],
+        select([goals.c.id,
+                db.func.count(teachers.c.id),
+                db.func.coalesce(db.func.sum(teachers.c.price), 0),
+                db.func.coalesce(db.func.sum(teacher_stats.c.review_count), 0),
+                db.func.coalesce(db.func.sum(teacher_stats.c.rating_sum), 0)])
+        .select_from(goals.outerjoin(teachers_goals, teachers_goals.c.goal_id == goals.c.id)
+                     .outerjoin(teachers, teachers.c.id == teachers_goals.c.teacher_id)
+                     .outerjoin(teacher_stats, teacher_stats.c.teacher_id == teachers.c.id))
+        .group_by(goals.c.id)))
+
+    # NULL for teachers without reviews, and a comparison with NULL is never true, so they keep their rating.
+    rating = select([average_rating(teacher_stats)])\
+        .where(teacher_stats.c.teacher_id == teachers.c.id, teacher_stats.c.review_count > 0)\
+        .scalar_subquery()
+    changed = connection.execute(teachers.update()
+                                 .where(rating != teachers.c.rating)
+                                 .values(rating=rating, version=teachers.c.version + 1)).rowcount
+    bump_catalog_version(connection)
+    db.session.commit()
+    page_cache.invalidate('catalog')
+    return changed
+
+
+@site.cli.command('reconcile-stats', help='Rebuild teacher and goal aggregates from reviews and teachers.')
+def reconcile_stats_command():
+    changed = reconcile_stats()
+    click.echo('Aggregates rebuilt, {} ratings changed.'.format(changed))
 
 
 # Database - Populating tables
-for goal in all_goals:
-    # without this check, "UNIQUE constraing failed" error comes out.
-    if db.session.query(Goal).filter(Goal.name_en == goal).count() < 1:
-        goal_for_db = Goal(name_en=goal, name_ru=all_goals[goal])
-        db.session.add(goal_for_db)
+# Nothing touches the database at import time: tables are created and filled by "flask seed",
+# run once per deploy (see Procfile) rather than by every gunicorn worker.
+SEED_BATCH_SIZE = 1000
+
+
+def teacher_hash(teacher):
+    # Of everything teachers.json says about a teacher, in one form (numbers as floats, the schedule packed, goals
+    # sorted), so that "flask import" can tell a changed record from an unchanged one without comparing columns.
+    content = [teacher['name'], teacher['about'], float(teacher['rating']), float(teacher['price']),
+               availability.pack_free(teacher['free']), sorted(teacher['goals'])]
+    return hashlib.sha1(json.dumps(content, ensure_ascii=False).encode()).hexdigest()
+
+
+def teacher_row(id, teacher):
+    return {'id': id,
+            'name': teacher['name'],
+            'about': teacher['about'],
+            'rating': teacher['rating'],
+            'price': teacher['price'],
+            'free': json.dumps(teacher['free']),
+            'free_mask': availability.pack_free(teacher['free']),
+            'content_hash': teacher_hash(teacher)}
+
+
+def seed_catalog(goals_path, teachers_path):
+    # Existing goals and teacher ids are fetched once, so running it again only adds what is missing.
+    # Everything is added in one transaction.
+    goal_ids = dict(db.session.query(Goal.name_en, Goal.id))
+    added_goals = 0
+    for name_en, name_ru in jsonstream.iter_object_items(goals_path):
+        if name_en not in goal_ids:
+            goal = Goal(name_en=name_en, name_ru=name_ru)
+            db.session.add(goal)
+            db.session.flush()
+            db.session.add(GoalStats(goal_id=goal.id))
+            goal_ids[name_en] = goal.id
+            added_goals += 1
+
+    existing_ids = set(id for id, in db.session.query(Teacher.id))
+    added_teachers = 0
+    teacher_rows = []
+    goal_rows = []
+    for key, teacher in jsonstream.iter_object_items(teachers_path):
+        id = int(key)
+        if id in existing_ids:
+            continue
+        existing_ids.add(id)
+        teacher_rows.append(teacher_row(id, teacher))
+        for goal in teacher['goals']:
+            goal_rows.append({'teacher_id': id, 'goal_id': goal_ids[goal]})
+        if len(teacher_rows) >= SEED_BATCH_SIZE:
+            added_teachers += insert_teachers(teacher_rows, goal_rows)
+            teacher_rows = []
+            goal_rows = []
+    added_teachers += insert_teachers(teacher_rows, goal_rows)
+
+    # Bulk inserts skip the ORM events that keep the search index and the catalog version up to date.
+    if added_teachers:
+        search_index.rebuild(db.session.connection(), teacher_documents(db.session.connection()))
+    if added_goals or added_teachers:
+        bump_catalog_version(db.session.connection())
+    db.session.commit()
+    if added_goals or added_teachers:
+        page_cache.invalidate('catalog')
+    return added_goals, added_teachers
+
+
+def insert_teachers(teacher_rows, goal_rows):
+    # One executemany per table instead of an ORM object per row.
+    if teacher_rows:
+        db.session.execute(Teacher.__table__.insert(), teacher_rows)
+        db.session.execute(TeacherStats.__table__.insert(), [{'teacher_id': row['id']} for row in teacher_rows])
+    if goal_rows:
+        db.session.execute(teachers_goals.insert(), goal_rows)
+        prices = {row['id']: row['price'] for row in teacher_rows}
+        deltas = {}
+        for row in goal_rows:
+            add_goal_delta(deltas, row['goal_id'], 1, prices[row['teacher_id']], 0, 0)
+        adjust_goal_stats(deltas)
+    return len(teacher_rows)
+
+
+@site.cli.command('seed', help='Create the tables and add goals and teachers that are not in the database yet.')
+@click.option('--goals', 'goals_path', default='goals.json', show_default=True)
+@click.option('--teachers', 'teachers_path', default='teachers.json', show_default=True)
+def seed(goals_path, teachers_path):
+    create_schema()
+    added_goals, added_teachers = seed_catalog(goals_path, teachers_path)
+    click.echo('Added {} goals and {} teachers.'.format(added_goals, added_teachers))
+
+
+# Database - Importing
+# "flask import" brings the database in line with edited goals.json and teachers.json. Teachers are streamed from the
+# file and compared by teacher_hash() with db_teachers.content_hash; only added, changed and removed teachers are
+# written, IMPORT_BATCH_SIZE at a time, each batch in its own short transaction together with its goal links,
+# aggregates, search documents and a catalog version bump, so pages and bookings go on while a large catalog is
+# refreshed. After each batch exactly the pages of its teachers, and of the goals whose teachers or stats changed, are
+# invalidated.
+# A changed teacher keeps the slots booked on the site, and the rating of its reviews once it has any.
+# Teachers missing from the file are deleted with their reviews; their bookings and leads stay, without a teacher.
+IMPORT_BATCH_SIZE = 1000
+
+
+def import_catalog(goals_path, teachers_path, dry_run=False):
+    # Returns a Counter of what was changed (with dry_run, of what would be; nothing is written).
+    # Raises click.ClickException for a goal that is not in goals.json (before anything is written) and for a name
+    # that is already taken. teachers.json is read twice: first to check it and find the changed teachers, then for
+    # the records of those teachers, so only a batch of records is in memory at a time.
+    report = Counter()
+    names = dict(jsonstream.iter_object_items(goals_path))
+    stored = dict(db.session.connection().execute(select([Teacher.id, Teacher.content_hash])).fetchall())
+    db.session.rollback()
+    changed = set()
+    for key, teacher in jsonstream.iter_object_items(teachers_path):
+        id = int(key)
+        unknown = sorted(set(teacher['goals']) - set(names))
+        if unknown:
+            raise click.ClickException('Teacher {} has goals that are not in {}: {}.'.format(
+                id, goals_path, ', '.join(unknown)))
+        if id in stored and stored.pop(id) == teacher_hash(teacher):
+            report['teachers unchanged'] += 1
+        else:
+            changed.add(id)
+
+    goal_ids, removed_goals = import_goals(names, report, dry_run)
+    # What is left of stored is not in the file. It goes first: names are unique, and a teacher moved to another id
+    # keeps the name.
+    removed_teachers = sorted(stored)
+    for start in range(0, len(removed_teachers), IMPORT_BATCH_SIZE):
+        delete_teachers(removed_teachers[start:start + IMPORT_BATCH_SIZE], report, dry_run)
+    if changed:
+        batch = []
+        for key, teacher in jsonstream.iter_object_items(teachers_path):
+            id = int(key)
+            if id not in changed:
+                continue
+            batch.append((id, teacher))
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                import_teachers(batch, goal_ids, report, dry_run)
+                batch = []
+        import_teachers(batch, goal_ids, report, dry_run)
+    delete_goals(removed_goals, report, dry_run)
+    return report
+
+
+def import_goals(names, report, dry_run):
+    # names: name_en -> name_ru from goals.json. Goals are few and are added and renamed in one transaction.
+    # Returns name_en -> id of the goals in the file (made-up ids for new goals with dry_run) and the ids of the goals
+    # that are not, deleted after the teachers.
+    goals = Goal.__table__
+    connection = db.session.connection()
+    goal_ids = {}
+    removed = []
+    renamed = []
+    for id, name_en, name_ru in connection.execute(select([goals.c.id, goals.c.name_en, goals.c.name_ru])).fetchall():
+        if name_en not in names:
+            removed.append(id)
+            continue
+        goal_ids[name_en] = id
+        if name_ru != names[name_en]:
+            renamed.append(id)
+            report['goals renamed'] += 1
+            if not dry_run:
+                connection.execute(goals.update().where(goals.c.id == id).values(name_ru=names[name_en]))
+    for name_en, name_ru in names.items():
+        if name_en in goal_ids:
+            continue
+        report['goals added'] += 1
+        if dry_run:
+            goal_ids[name_en] = -report['goals added']
+            continue
+        id = connection.execute(goals.insert().values(name_en=name_en, name_ru=name_ru)).inserted_primary_key[0]
+        connection.execute(GoalStats.__table__.insert().values(goal_id=id))
+        goal_ids[name_en] = id
+    if dry_run or not (report['goals added'] or report['goals renamed']):
+        db.session.rollback()
+        return goal_ids, removed
+    bump_catalog_version(connection)
+    db.session.commit()
+    page_cache.invalidate('catalog')
+    if renamed:
+        reindex_goal_teachers(renamed)
+    return goal_ids, removed
+
+
+def reindex_goal_teachers(goal_ids):
+    # Goal names are part of the search documents of their teachers, which are re-indexed in batches after a rename.
+    teacher_ids = [id for id, in db.session.connection().execute(select([teachers_goals.c.teacher_id]).distinct()
+                                                                 .where(teachers_goals.c.goal_id.in_(goal_ids))
+                                                                 .order_by(teachers_goals.c.teacher_id))]
+    for start in range(0, len(teacher_ids), IMPORT_BATCH_SIZE):
+        batch = teacher_ids[start:start + IMPORT_BATCH_SIZE]
+        connection = db.session.connection()
+        search_index.update(connection, list(teacher_documents(connection, batch)))
+        db.session.commit()
+
+
+def import_teachers(batch, goal_ids, report, dry_run):
+    # Adds and updates a batch of (id, teachers.json record) in one transaction.
+    if not batch:
+        return
+    ids = [id for id, teacher in batch]
+    teachers = Teacher.__table__
+    connection = db.session.connection()
+    # What the teachers were: price, rating, reviews and goals for the aggregates, booked slots for the schedule.
+    before = {row.id: row for row in connection.execute(
+        select([teachers.c.id, teachers.c.price, teachers.c.rating, TeacherStats.review_count, TeacherStats.rating_sum])
+        .select_from(teachers.outerjoin(TeacherStats, TeacherStats.teacher_id == teachers.c.id))
+        .where(teachers.c.id.in_(ids)))}
+    old_goals = {}
+    for teacher_id, goal_id in connection.execute(select([teachers_goals.c.teacher_id, teachers_goals.c.goal_id])
+                                                  .where(teachers_goals.c.teacher_id.in_(ids))):
+        old_goals.setdefault(teacher_id, set()).add(goal_id)
+    booked = {}
+    for teacher_id, day, time in connection.execute(select([Booking.teacher_id, Booking.day, Booking.time])
+                                                    .where(Booking.teacher_id.in_(ids))):
+        booked[teacher_id] = booked.get(teacher_id, 0) | availability.slot_bit(day, times[time])
+
+    inserts = []
+    updates = []
+    added_links = []
+    removed_links = []
+    deltas = {}
+    for id, teacher in batch:
+        row = teacher_row(id, teacher)
+        goals = {goal_ids[name] for name in teacher['goals']}
+        previous = old_goals.get(id, set())
+        old = before.get(id)
+        if old is None:
+            inserts.append(row)
+            reviews, ratings = 0, 0
+        else:
+            reviews, ratings = old.review_count or 0, old.rating_sum or 0
+            row['free_mask'] &= ~booked.get(id, 0)
+            if reviews:
+                row['rating'] = old.rating
+            updates.append({'b_' + column: value for column, value in row.items()})
+            for goal_id in previous:
+                add_goal_delta(deltas, goal_id, -1, -old.price, -reviews, -ratings)
+        for goal_id in goals:
+            add_goal_delta(deltas, goal_id, 1, row['price'], reviews, ratings)
+        added_links.extend({'teacher_id': id, 'goal_id': goal_id} for goal_id in sorted(goals - previous))
+        removed_links.extend({'b_teacher_id': id, 'b_goal_id': goal_id} for goal_id in sorted(previous - goals))
+    report['teachers added'] += len(inserts)
+    report['teachers updated'] += len(updates)
+    report['goal links added'] += len(added_links)
+    report['goal links removed'] += len(removed_links)
+    if dry_run:
+        db.session.rollback()
+        return
+
+    try:
+        if inserts:
+            connection.execute(teachers.insert(), inserts)
+            connection.execute(TeacherStats.__table__.insert(), [{'teacher_id': row['id']} for row in inserts])
+        if updates:
+            connection.execute(teachers.update()
+                               .where(teachers.c.id == bindparam('b_id'))
+                               .values(name=bindparam('b_name'), about=bindparam('b_about'),
+                                       rating=bindparam('b_rating'), price=bindparam('b_price'),
+                                       free=bindparam('b_free'), free_mask=bindparam('b_free_mask'),
+                                       content_hash=bindparam('b_content_hash'), version=teachers.c.version + 1),
+                               updates)
+    except IntegrityError as error:
+        # db_teachers.name is unique: two teachers of the file have one name, or one takes the name another teacher
+        # still has. Batches before this one stay; running the import again after fixing the file finishes the job.
+        db.session.rollback()
+        raise click.ClickException(name_clash(batch) or 'Teachers {} to {} could not be written: {}'.format(
+            ids[0], ids[-1], error.orig))
+    if removed_links:
+        connection.execute(teachers_goals.delete().where(teachers_goals.c.teacher_id == bindparam('b_teacher_id'),
+                                                         teachers_goals.c.goal_id == bindparam('b_goal_id')),
+                           removed_links)
+    if added_links:
+        connection.execute(teachers_goals.insert(), added_links)
+    adjust_goal_stats(deltas)
+    search_index.update(connection, list(teacher_documents(connection, ids)))
+    bump_catalog_version(connection)
+    db.session.commit()
+    # Goals whose stats have not moved show these teachers on their pages, which have the teacher tags.
+    page_cache.invalidate(*['teacher:{}'.format(id) for id in ids],
+                          *['goal:{}'.format(goal_id) for goal_id, delta in deltas.items() if any(delta)])
+
+
+def name_clash(batch):
+    # "Teacher 200 has the name of teacher 5 ..." for the first teacher of the batch whose name is taken, or None.
+    names = {}
+    for id, teacher in batch:
+        if teacher['name'] in names:
+            return 'Teachers {} and {} have the same name, {}.'.format(names[teacher['name']], id, teacher['name'])
+        names[teacher['name']] = id
+    rows = db.session.connection().execute(select([Teacher.id, Teacher.name]).where(Teacher.name.in_(names)))
+    for id, name in rows:
+        if id != names[name]:
+            return 'Teacher {} has the name of teacher {}, {}.'.format(names[name], id, name)
+    return None
+
+
+def delete_teachers(ids, report, dry_run):
+    teachers = Teacher.__table__
+    connection = db.session.connection()
+    deltas = {}
+    links = connection.execute(select([teachers_goals.c.goal_id, teachers.c.price, TeacherStats.review_count,
+                                       TeacherStats.rating_sum])
+                               .select_from(teachers_goals.join(teachers, teachers.c.id == teachers_goals.c.teacher_id)
+                                            .outerjoin(TeacherStats, TeacherStats.teacher_id == teachers.c.id))
+                               .where(teachers_goals.c.teacher_id.in_(ids))).fetchall()
+    for goal_id, price, reviews, ratings in links:
+        add_goal_delta(deltas, goal_id, -1, -price, -(reviews or 0), -(ratings or 0))
+    report['teachers deleted'] += len(ids)
+    report['goal links removed'] += len(links)
+    if dry_run:
+        db.session.rollback()
+        return
+
+    for model in (Booking, Lead):
+        connection.execute(model.__table__.update().where(model.teacher_id.in_(ids)).values(teacher_id=None))
+    for table, column in ((Review.__table__, 'teacher_id'), (teachers_goals, 'teacher_id'),
+                          (TeacherStats.__table__, 'teacher_id'), (teachers, 'id')):
+        connection.execute(table.delete().where(table.c[column].in_(ids)))
+    adjust_goal_stats(deltas)
+    search_index.delete(connection, ids)
+    bump_catalog_version(connection)
+    db.session.commit()
+    page_cache.invalidate(*['teacher:{}'.format(id) for id in ids], *['goal:{}'.format(goal_id) for goal_id in deltas])
+
+
+def delete_goals(ids, report, dry_run):
+    # By now no teacher has these goals: teachers still in teachers.json cannot, the others are gone.
+    if not ids:
+        return
+    report['goals deleted'] += len(ids)
+    if dry_run:
+        return
+    connection = db.session.connection()
+    for table, column in ((teachers_goals, 'goal_id'), (GoalStats.__table__, 'goal_id'), (Goal.__table__, 'id')):
+        connection.execute(table.delete().where(table.c[column].in_(ids)))
+    bump_catalog_version(connection)
+    db.session.commit()
+    page_cache.invalidate('catalog', *['goal:{}'.format(id) for id in ids])
+
+
+@site.cli.command('import', help='Apply the changes in goals.json and teachers.json to the database.')
+@click.option('--goals', 'goals_path', default='goals.json', show_default=True)
+@click.option('--teachers', 'teachers_path', default='teachers.json', show_default=True)
+@click.option('--dry-run', is_flag=True, help='Only report what would change.')
+def import_command(goals_path, teachers_path, dry_run):
+    started = clock.time()
+    create_schema()
+    report = import_catalog(goals_path, teachers_path, dry_run)
+    click.echo('Goals: {} added, {} renamed, {} deleted.'.format(
+        report['goals added'], report['goals renamed'], report['goals deleted']))
+    click.echo('Teachers: {} added, {} updated, {} deleted, {} unchanged; goal links: {} added, {} removed.'.format(
+        report['teachers added'], report['teachers updated'], report['teachers deleted'], report['teachers unchanged'],
+        report['goal links added'], report['goal links removed']))
+    click.echo('{} in {:.1f} s.'.format('Dry run, nothing written,' if dry_run else 'Done', clock.time() - started))
+
+
+# Database - Queries
+def free_in(mask):
+    # Condition "free in at least one of the slots in mask", e.g.
+    # db.session.query(Teacher).filter(free_in(availability.slot_bit('tue', '10:00'))) - teachers free on Tuesday at 10:00.
+    return Teacher.free_mask.op('&')(mask) != 0
+
+
+# Database - Read models
+# What profile and booking pages need of a teacher: the catalog snapshot has everything but the schedule, which is read
+# from the row itself together with the version it belongs to (one primary key lookup).
+# A namedtuple is immutable and has no per-instance __dict__, and templates never get a live ORM object.
+ProfileView = namedtuple('ProfileView', ['id', 'name', 'about', 'rating', 'price', 'goals', 'free_mask', 'version',
+                                         'review_count'])
+
+
+def load_profile(id):
+    catalog = get_catalog()
+    teacher = catalog.teacher(id)
+    if teacher is None:
+        return None
+    row = db.session.connection().execute(select([Teacher.free_mask, Teacher.version]).where(Teacher.id == id)).first()
+    if row is None:
+        return None
+    return ProfileView(id=teacher.id,
+                       name=teacher.name,
+                       about=teacher.about,
+                       rating=teacher.rating,
+                       price=teacher.price,
+                       goals=catalog.goal_names(teacher),
+                       free_mask=row.free_mask,
+                       version=row.version,
+                       review_count=teacher.review_count)
+
+
+# Search index
+search_index = SearchIndex()
+SEARCH_BATCH_SIZE = 1000
+
+
+def teacher_documents(connection, ids=None):
+    # (id, name, about, goal names) for search_index, read in batches in id order.
+    goal_names = database.group_concat(Goal.name_en + ' ' + Goal.name_ru, ' ')
+    last_id = 0
+    while True:
+        query = select([Teacher.id, Teacher.name, Teacher.about, goal_names])\
+            .select_from(Teacher.__table__.outerjoin(teachers_goals).outerjoin(Goal.__table__))\
+            .where(Teacher.id > last_id)\
+            .group_by(Teacher.id)\
+            .order_by(Teacher.id)\
+            .limit(SEARCH_BATCH_SIZE)
+        if ids is not None:
+            query = query.where(Teacher.id.in_(ids))
+        rows = connection.execute(query).fetchall()
+        for row in rows:
+            yield tuple(row)
+        if len(rows) < SEARCH_BATCH_SIZE:
+            return
+        last_id = rows[-1][0]
+
+
+@event.listens_for(db.session, 'after_flush')
+def reindex_teachers(session, flush_context):
+    # Teachers added, edited or deleted through the ORM are re-indexed in the same transaction.
+    # (session.new/dirty/deleted still hold what has just been flushed.)
+    changed = [obj.id for obj in list(session.new) + list(session.dirty) if isinstance(obj, Teacher)]
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, Teacher)]
+    if changed:
+        search_index.update(session.connection(), list(teacher_documents(session.connection(), changed)))
+    if deleted:
+        search_index.delete(session.connection(), deleted)
+
+
+# Page cache
+# Every app has its own, with the backend its config asks for; page_cache is the one of the current app.
+# Pages may be kept per worker, but their tag versions are in db_cache_tags: an invalidation by any process (a booking
+# in another worker, flask import) reaches every worker, and a cache hit costs one query for the page's tags.
+page_cache = LocalProxy(lambda: current_app.extensions['page_cache'])
+
+
+class DatabaseTags:
+    def versions(self, tags):
+        found = dict(db.session.connection().execute(select([CacheTag.tag, CacheTag.version])
+                                                     .where(CacheTag.tag.in_(tags))).fetchall())
+        return tuple(found.get(tag, 0) for tag in tags)
+
+    def bump(self, tags):
+        # Called once the change is committed (also from after_commit), so on a connection and transaction of its own.
+        with db.engine.begin() as connection:
+            database.increment(connection, CacheTag.__table__, 'tag', 'version', sorted(set(tags)))
+
+
+def init_page_cache(app):
+    if app.config['PAGE_CACHE'] == 'sqlite':
+        backend = SQLiteBackend(app.config['PAGE_CACHE_PATH'], app.config['PAGE_CACHE_TTL'],
+                                app.config['PAGE_CACHE_SIZE'])
+    else:
+        backend = LocalBackend(app.config['PAGE_CACHE_SIZE'], app.config['PAGE_CACHE_TTL'])
+    app.extensions['page_cache'] = PageCache(backend, app.config['PAGE_CACHE_TTL'], DatabaseTags())
+
+
+def cache_tags(*tags):
+    # Called by cached views as soon as they know what the page depends on:
+    # 'catalog' (everything), 'goal:<id>', 'teacher:<id>'.
+    if 'cache_versions' in g:
+        for tag, version in zip(tags, page_cache.versions(tags)):
+            g.cache_versions.setdefault(tag, version)
+
+
+def cached_page(ttl=None, query_args=()):
+    # Serves the rendered page from page_cache, with an ETag and Last-Modified so that browsers
+    # that already have it get 304 Not Modified without the page being rendered at all.
+    # A view may return a stream (stream_page()): the page is then sent as it is rendered and cached once it is complete.
+    # query_args are the query arguments the view reads: the page is cached per path and their values, so any other
+    # arguments (/?x=<random>) get the same page instead of a cache entry each.
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if current_app.config['PAGE_CACHE'] == 'off':
+                return view(*args, **kwargs)
+            key = page_key(query_args)
+            page = page_cache.get(key)
+            if page is None:
+                g.cache_versions = {}
+                snapshot = catalog_snapshot
+                body = view(*args, **kwargs)
+                if not isinstance(body, str):
+                    response = Response(cache_stream(current_app._get_current_object(), key, body, g.cache_versions,
+                                                     ttl, snapshot))
+                    response.cache_control.no_cache = True
+                    return response
+                if not catalog_settled(snapshot):
+                    return body
+                page = page_cache.set(key, body, g.cache_versions, ttl, compressed_variants(body))
+            return page_response(page)
+        return wrapper
+    return decorator
+
+
+def page_key(query_args):
+    values = [(name, request.args[name]) for name in query_args if name in request.args]
+    return request.path + '?' + urlencode(values) if values else request.path
+
+
+def catalog_settled(snapshot):
+    # Pages are made from the catalog snapshot, which may be a moment behind the database after a change, while the
+    # change invalidates cached pages at once. A page is cached only if the snapshot it was made from (snapshot, or the
+    # one built for it when there was none) is still the latest catalog; otherwise it is sent but not kept.
+    current = catalog_snapshot
+    if catalog_rebuilding or current is None or (snapshot is not None and current is not snapshot):
+        return False
+    return read_catalog_version(db.session.connection()) == current.version
+
+
+def cache_stream(app, key, chunks, versions, ttl, snapshot):
+    # Passes a streamed page on and caches it after the last chunk; a stream cut short is not cached.
+    # Runs after the request context of the stream is gone, so everything it needs is passed in.
+    body = []
+    try:
+        for chunk in chunks:
+            body.append(chunk)
+            yield chunk
+    finally:
+        chunks.close()
+    with app.app_context():
+        try:
+            if catalog_settled(snapshot):
+                body = ''.join(body)
+                page_cache.set(key, body, versions, ttl, compressed_variants(body))
+        finally:
+            db.session.remove()
+
+
+def page_response(page):
+    # The compressed variant of the page the client takes, if any; every variant has an ETag of its own.
+    if current_app.config['COMPRESSION']:
+        encoding = compress.negotiate(request.accept_encodings, page.variants)
+    else:
+        encoding = None
+    if encoding is None:
+        response = make_response(page.body)
+        response.set_etag(page.etag)
+    else:
+        response = make_response(page.variants[encoding])
+        response.headers['Content-Encoding'] = encoding
+        response.set_etag('{}-{}'.format(page.etag, encoding))
+    if page.variants:
+        response.vary.add('Accept-Encoding')
+    response.last_modified = page.last_modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@event.listens_for(db.session, 'after_flush')
+def collect_cache_tags(session, flush_context):
+    # Pages of teachers and goals changed through the ORM are invalidated once the transaction commits.
+    tags = session.info.setdefault('cache_tags', set())
+    teacher_ids = []
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Teacher):
+            teacher_ids.append(obj.id)
+            tags.add('teacher:{}'.format(obj.id))
+        elif isinstance(obj, Review):
+            # A review changes the teacher's rating and the stats of the teacher's goals.
+            teacher_ids.append(obj.teacher_id)
+            tags.add('teacher:{}'.format(obj.teacher_id))
+        elif isinstance(obj, Goal):
+            tags.add('goal:{}'.format(obj.id))
+    if teacher_ids:
+        # Goal pages the teacher has just been added to; pages that already show the teacher have its tag.
+        rows = session.connection().execute(select([teachers_goals.c.goal_id])
+                                            .where(teachers_goals.c.teacher_id.in_(teacher_ids)))
+        tags.update('goal:{}'.format(row[0]) for row in rows)
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_cache_tags(session):
+    tags = session.info.pop('cache_tags', None)
+    if tags:
+        page_cache.invalidate(*tags)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_cache_tags(session):
+    session.info.pop('cache_tags', None)
+
+
+# Catalog snapshot
+# Pages read goals and teachers from a Catalog (catalog.py) instead of the database. Every change of goals, teachers or
+# reviews bumps db_catalog.version in its own transaction: through the ORM by bump_catalog_on_flush(), bulk writes call
+# bump_catalog_version() themselves. A worker compares the version with its snapshot's at most every
+# CATALOG_CHECK_INTERVAL seconds (right away after a change it has committed itself) and builds the new snapshot in a
+# background thread, serving the old one meanwhile; the new one replaces it in a single assignment.
+# Schedules (free_mask) change with every booking and are still read from the database.
+CATALOG_CHECK_INTERVAL = 2
+
+catalog_snapshot = None
+catalog_checked = 0
+catalog_rebuilding = False
+catalog_lock = threading.Lock()
+
+
+def bump_catalog_version(connection):
+    connection.execute(CatalogVersion.__table__.update().values(version=CatalogVersion.version + 1))
+
+
+@event.listens_for(db.session, 'after_flush')
+def bump_catalog_on_flush(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (Teacher, Goal, Review)):
+            bump_catalog_version(session.connection())
+            session.info['catalog_changed'] = True
+            return
+
+
+@event.listens_for(db.session, 'after_commit')
+def check_catalog_soon(session):
+    global catalog_checked
+    if session.info.pop('catalog_changed', False):
+        catalog_checked = 0
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_catalog_change(session):
+    session.info.pop('catalog_changed', None)
+
+
+def read_catalog_version(connection):
+    return connection.execute(select([CatalogVersion.version])).scalar() or 0
+
+
+def build_catalog():
+    # numpy is imported on first use rather than with the app.
+    from catalog import Catalog
+    connection = db.session.connection()
+    # The version is read before the rows: rows newer than their version only cost one more rebuild.
+    version = read_catalog_version(connection)
+    goal_masks = teacher_goal_masks()
+    teacher_rows = connection.execute(select([Teacher.id, Teacher.name, Teacher.about, Teacher.rating, Teacher.price,
+                                              Teacher.version, TeacherStats.review_count])
+                                      .select_from(Teacher.__table__.outerjoin(TeacherStats,
+                                                                               TeacherStats.teacher_id == Teacher.id))
+                                      .order_by(Teacher.id))
+    teachers = ((id, name, about, rating, price, teacher_version, review_count or 0, goal_masks.get(id, 0))
+                for id, name, about, rating, price, teacher_version, review_count in teacher_rows)
+    goals = connection.execute(select([Goal.id, Goal.name_en, Goal.name_ru, GoalStats.teacher_count,
+                                       GoalStats.price_sum, GoalStats.review_count, GoalStats.rating_sum])
+                               .select_from(Goal.__table__.outerjoin(GoalStats, GoalStats.goal_id == Goal.id))
+                               .order_by(Goal.id)).fetchall()
+    catalog = Catalog(version, teachers,
+                   [(id, name_en, name_ru, teacher_count or 0, price_sum or 0, review_count or 0, rating_sum or 0)
+                    for id, name_en, name_ru, teacher_count, price_sum, review_count, rating_sum in goals],
+                   GOAL_PAGE_SORTS)
+    # Whatever changed the catalog may have changed search documents too, maybe in another process.
+    search_index.refresh(connection, lambda: teacher_documents(connection))
+    return catalog
+
+
+def get_catalog():
+    global catalog_snapshot, catalog_checked
+    if catalog_snapshot is None:
+        with catalog_lock:
+            if catalog_snapshot is None:
+                catalog_checked = clock.time()
+                catalog_snapshot = build_catalog()
+        return catalog_snapshot
+    now = clock.time()
+    if now - catalog_checked > CATALOG_CHECK_INTERVAL:
+        catalog_checked = now
+        if read_catalog_version(db.session.connection()) != catalog_snapshot.version:
+            rebuild_catalog()
+    return catalog_snapshot
+
+
+def rebuild_catalog():
+    global catalog_rebuilding
+    with catalog_lock:
+        if catalog_rebuilding:
+            return
+        catalog_rebuilding = True
+    app = current_app._get_current_object()
+
+    def rebuild():
+        global catalog_snapshot, catalog_rebuilding
+        try:
+            with app.app_context():
+                try:
+                    catalog_snapshot = build_catalog()
+                finally:
+                    db.session.remove()
+        except Exception:
+            app.logger.exception('Catalog snapshot rebuild failed')
+        finally:
+            catalog_rebuilding = False
+
+    threading.Thread(target=rebuild, name='catalog-rebuild', daemon=True).start()
+
+
+# Fragment cache
+# Teacher cards (index, goal and search pages) and profile schedules are rendered once per teacher version
+# and pasted into pages as ready HTML. Any change of a teacher bumps Teacher.version, so a changed teacher
+# gets a new key and the old fragment is never shown again; it just ages out of the LRU. Every app has its own.
+fragment_cache = LocalProxy(lambda: current_app.extensions['fragment_cache'])
+
+
+def render_fragment(template_name, key, **context):
+    fragment = fragment_cache.get(key)
+    if fragment is None:
+        fragment = Markup(current_app.jinja_env.get_template(template_name).render(**context))
+        fragment_cache.set(key, fragment)
+    return fragment
+
+
+def teacher_card(teacher):
+    # teacher: a row with id, name, rating, price, about and version.
+    return render_fragment('teacher_card.html', ('card', teacher.id, teacher.version), teacher=teacher)
+
+
+def teacher_schedule(teacher):
+    return render_fragment('schedule.html', ('schedule', teacher.id, teacher.version),
+                           id=teacher.id,
+                           free=availability.unpack_free(teacher.free_mask),
+                           days=days,
+                           times=times)
+
+
+# Streamed pages
+# Goal and index pages are sent while their template renders: the head, with the stylesheet the browser can start
+# fetching, goes out before the cards are rendered, and the cards are rendered one by one as the template reaches them
+# (teacher_cards()). Jinja yields every piece of text and every {{ }} on its own; they are sent in chunks of at least
+# STREAM_CHUNK_SIZE characters.
+STREAM_CHUNK_SIZE = 4096
 
 
-for teacher in teachers:
-    # without this check, "UNIQUE constraing failed" error comes out.
-    if db.session.query(Teacher).filter(Teacher.id == int(teacher)).count() < 1:
-        free = json.dumps(teachers[teacher]['free'])
-        teacher_for_db = Teacher(id=int(teacher),
-                                 name=teachers[teacher]['name'],
-                                 about=teachers[teacher]['about'],
-                                 rating=teachers[teacher]['rating'],
-                                 price=teachers[teacher]['price'],
-                                 free=free)
-        db.session.add(teacher_for_db)
-        for goal in teachers[teacher]['goals']:
-            goal_for_db = db.session.query(Goal).filter(Goal.name_en == goal).first()
-            teacher_for_db.goals.append(goal_for_db)
+def stream_page(template_name, **context):
+    # Like render_template(), but returns the page as an iterator of chunks. The template context is made here,
+    # while the request is on; stream_template() keeps the request context for the rendering that comes later.
+    return join_chunks(stream_template(template_name, **context))
 
 
+def join_chunks(events):
+    buffer = []
+    size = 0
+    try:
+        for event in events:
+            buffer.append(event)
+            size += len(event)
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(buffer)
+                buffer = []
+                size = 0
+    finally:
+        events.close()
+    if buffer:
+        yield ''.join(buffer)
 
-db.session.commit()
+
+def teacher_cards(teachers):
+    for teacher in teachers:
+        cache_tags('teacher:{}'.format(teacher.id))
+        yield teacher_card(teacher)
+
+
+# Matching
+# One lesson a slot; a bucket needs at least as many free slots a week as its lower bound.
+DURATION_SLOTS = {'1-2': 1, '3-5': 3, '5-7': 5, '7-9': 7}
+MATCH_LIMIT = 10
+# The matcher is rebuilt from the database at most this often, in a background thread like the catalog snapshot;
+# bookings made in this worker update it in place meanwhile.
+MATCHER_TTL = 60
+matcher = None
+matcher_built = 0
+matcher_rebuilding = False
+matcher_lock = threading.Lock()
+
+
+def teacher_goal_masks():
+    # teacher id -> 1 << goal id for every goal of the teacher, added up by the database ((teacher, goal) pairs are
+    # unique). Goal bits need goal ids below 63 to fit into int64 numpy arrays, and BIGINT on PostgreSQL, whose sum of
+    # BIGINTs is a NUMERIC.
+    goal_bit = db.cast(db.literal(1), db.BigInteger).op('<<')(teachers_goals.c.goal_id)
+    goal_mask = db.cast(db.func.sum(goal_bit), db.BigInteger)
+    # Plain Core rows on the connection are a few times cheaper than ORM rows at one row per teacher.
+    return dict(db.session.connection().execute(select([teachers_goals.c.teacher_id, goal_mask])
+                                                 .group_by(teachers_goals.c.teacher_id)).fetchall())
+
+
+def build_matcher():
+    # numpy is imported on first use rather than with the app.
+    from matching import Matcher
+    goal_masks = teacher_goal_masks()
+    # In id order, for Matcher.take.
+    rows = db.session.query(Teacher.id, Teacher.rating, Teacher.price, Teacher.free_mask).order_by(Teacher.id)
+    return Matcher(((id, rating, price, free_mask, goal_masks.get(id, 0)) for id, rating, price, free_mask in rows),
+                   BOOKABLE_MASK)
+
+
+def get_matcher():
+    global matcher, matcher_built
+    if matcher is None:
+        with matcher_lock:
+            if matcher is None:
+                matcher = build_matcher()
+                matcher_built = clock.time()
+    elif clock.time() - matcher_built > MATCHER_TTL:
+        rebuild_matcher()
+    return matcher
+
+
+def rebuild_matcher():
+    global matcher_rebuilding
+    with matcher_lock:
+        if matcher_rebuilding:
+            return
+        matcher_rebuilding = True
+    app = current_app._get_current_object()
+
+    def rebuild():
+        global matcher, matcher_built, matcher_rebuilding
+        try:
+            with app.app_context():
+                try:
+                    matcher = build_matcher()
+                    matcher_built = clock.time()
+                finally:
+                    db.session.remove()
+        except Exception:
+            app.logger.exception('Matcher rebuild failed')
+        finally:
+            matcher_rebuilding = False
+
+    threading.Thread(target=rebuild, name='matcher-rebuild', daemon=True).start()
+
+
+# Slot search
+# "Free on <day> at <time> (for <goal>)" is answered by a SlotIndex (slots.py) in every worker, rebuilt at most
+# every SLOT_INDEX_TTL seconds and updated in place by bookings made in this worker. It may not know yet about
+# bookings made in other workers, so pages take candidates from it and still check free_mask in SQL.
+# Building it reads every teacher (under a second at 100k), and a stale index only costs a few candidates that SQL
+# drops, so it is kept longer than the matcher. Like the matcher, an expired index is rebuilt in a background thread
+# while the old one keeps serving.
+SLOT_INDEX_TTL = 300
+slot_index = None
+slot_index_built = 0
+slot_index_rebuilding = False
+slot_index_lock = threading.Lock()
+
+
+def build_slot_index():
+    from slots import SlotIndex
+    goal_masks = teacher_goal_masks()
+    rows = db.session.connection().execute(select([Teacher.id, Teacher.free_mask]))
+    return SlotIndex((id, free_mask, goal_masks.get(id, 0)) for id, free_mask in rows)
+
+
+def slot_index_ttl():
+    # Workers forked from a preloaded master share its index and would all rebuild it at the same moment;
+    # every process keeps it up to a quarter longer, by its pid.
+    return SLOT_INDEX_TTL * (1 + os.getpid() % 64 / 256)
+
+
+def get_slot_index():
+    global slot_index, slot_index_built
+    if slot_index is None:
+        with slot_index_lock:
+            if slot_index is None:
+                slot_index = build_slot_index()
+                slot_index_built = clock.time()
+    elif clock.time() - slot_index_built > slot_index_ttl():
+        rebuild_slot_index()
+    return slot_index
+
+
+def rebuild_slot_index():
+    global slot_index_rebuilding
+    with slot_index_lock:
+        if slot_index_rebuilding:
+            return
+        slot_index_rebuilding = True
+    app = current_app._get_current_object()
+
+    def rebuild():
+        global slot_index, slot_index_built, slot_index_rebuilding
+        try:
+            with app.app_context():
+                try:
+                    slot_index = build_slot_index()
+                    slot_index_built = clock.time()
+                finally:
+                    db.session.remove()
+        except Exception:
+            app.logger.exception('Slot index rebuild failed')
+        finally:
+            slot_index_rebuilding = False
+
+    threading.Thread(target=rebuild, name='slot-index-rebuild', daemon=True).start()
+
+
+def slot_filter():
+    # (day, time) from ?day=wed&time=10 (keys of days and times), or None.
+    day = request.args.get('day')
+    time = request.args.get('time')
+    if day in days and time in times:
+        return day, time
+    return None
+
+
+# Notifications
+# Bookings and messages are sent to the school by "flask worker" processes, not by the request that made them.
+job_queue = JobQueue(db, Job)
+
+
+@site.cli.command('worker', help='Deliver queued booking and message notifications until interrupted.')
+@click.option('--threads', default=2, show_default=True, help='Worker threads in this process.')
+@click.option('--poll-interval', default=1.0, show_default=True, help='Seconds to wait when no jobs are due.')
+def worker(threads, poll_interval):
+    job_queue.run_workers(current_app._get_current_object(), threads=threads, poll_interval=poll_interval)
+
+
+# Intake
+# Lead forms are throttled per client IP and per phone (intake.py) before anything else is done with the request,
+# then kept as Lead rows: ix_leads_idempotency_key turns a resubmitted form into a no-op and ix_leads_dedup keeps one
+# phone from leaving the same lead twice. Either way the visitor gets the "sent" page again and no second notification.
+def init_intake(app):
+    # app.extensions['intake'] is (IP limiter, phone limiter) or None.
+    config = app.config
+    if config['INTAKE_STORE'] == 'off':
+        app.extensions['intake'] = None
+        return
+    store = SQLiteStore(config['INTAKE_STORE_PATH']) if config['INTAKE_STORE'] == 'sqlite' else MemoryStore()
+    app.extensions['intake'] = (RateLimiter(store, config['INTAKE_IP_BURST'], config['INTAKE_IP_PER_MINUTE']),
+                                RateLimiter(store, config['INTAKE_PHONE_BURST'], config['INTAKE_PHONE_PER_MINUTE']))
+
+
+def throttled(view):
+    # A POST over a limit gets a plain 429 with Retry-After: no form validation, no query, no template.
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        limiters = current_app.extensions['intake']
+        if request.method == 'POST' and limiters is not None:
+            ip_limiter, phone_limiter = limiters
+            retry_after = ip_limiter.hit('ip:{}'.format(request.remote_addr))
+            phone = normalize_phone(request.form.get('phone'))
+            if retry_after is None and phone is not None:
+                retry_after = phone_limiter.hit('phone:' + phone)
+            if retry_after is not None:
+                return Response('Слишком много заявок, попробуйте позже\n', status=429, mimetype='text/plain',
+                                headers={'Retry-After': str(math.ceil(retry_after))})
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def lead_subject(*parts):
+    # 'teacher:5:wed:10' for a booking, 'teacher:5:<date>:<sha1 of the text>' for a message,
+    # 'travel:1-2:any:None:<date>' for a pick request: the same message or request is taken once a day.
+    return ':'.join(str(part) for part in parts)
+
+
+def add_lead(kind, name, phone, subject, idempotency_key=None, teacher_id=None):
+    # Committed together with the booking or job; the caller catches IntegrityError from the two unique indexes.
+    db.session.add(Lead(kind=kind, teacher_id=teacher_id, name=name, phone=phone, subject=subject,
+                        idempotency_key=idempotency_key or None, created_at=clock.time()))
+
+
+def lead_exists(kind, phone, subject, idempotency_key=None):
+    condition = db.and_(Lead.kind == kind, Lead.phone == phone, Lead.subject == subject)
+    if idempotency_key:
+        condition = db.or_(Lead.idempotency_key == idempotency_key, condition)
+    return db.session.query(db.exists().where(condition)).scalar()
+
+
+# Static assets
+# Templates link static files through asset_url() and the photo macro (templates/photo.html); see assets.py.
+def init_assets(app):
+    static_files = assets.Assets()
+    static_files.load(app.static_folder)
+    app.extensions['assets'] = static_files
+    app.jinja_env.globals.update(asset_url=static_files.url,
+                                 has_asset=static_files.has,
+                                 photo_urls=static_files.photo_urls)
+
+
+@site.route('/assets/<path:filename>')
+def hashed_asset(filename):
+    # The name changes with the content, so the browser may keep the file for good.
+    response = send_from_directory(os.path.join(current_app.static_folder, assets.DIST), filename,
+                                   max_age=assets.MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+assets_cli = AppGroup('assets', help='Static files: hashed copies, thumbnails and vendored third-party files.')
+site.cli.add_command(assets_cli)
+
+
+@assets_cli.command('build', help='Write hashed static files, photo thumbnails and the manifest to static/dist/.')
+def build_assets():
+    manifest = assets.build(current_app.static_folder)
+    click.echo('Built {} files; photos of {} teachers.'.format(len(manifest['files']), len(manifest['photos'])))
+
+
+@assets_cli.command('vendor', help='Download the third-party files pages use into static/vendor/.')
+def vendor_assets():
+    fetched = assets.fetch_vendor(current_app.static_folder)
+    click.echo('Fetched {}.'.format(', '.join(fetched)) if fetched else 'Everything is in static/vendor/ already.')
+
+
+# Compression
+# Text responses are compressed (compress.py) as the client's Accept-Encoding allows: streamed ones chunk by chunk as
+# they are sent, others whole. Cached pages keep variants compressed once, when they are cached (page_response()), so
+# a cache hit costs no compression at all.
+def init_compression(app):
+    if app.config['COMPRESSION']:
+        app.after_request(compress_response)
+
+
+def compressed_variants(body):
+    # Content-Encoding -> the page compressed at the best level; none for small pages.
+    data = body.encode('utf-8')
+    if not current_app.config['COMPRESSION'] or len(data) < current_app.config['COMPRESSION_MIN_SIZE']:
+        return {}
+    return {encoding: compress.compress(data, encoding, compress.BEST) for encoding in compress.ENCODINGS}
+
+
+def compress_response(response):
+    # Files (direct_passthrough) and responses compressed already, like cached pages, are left as they are.
+    if response.direct_passthrough or 'Content-Encoding' in response.headers \
+            or response.mimetype not in compress.COMPRESSIBLE or response.status_code in (204, 304):
+        return response
+    # Error pages made by werkzeug count as streamed but have a Content-Length: the size is checked whenever it is known.
+    length = response.content_length if response.is_streamed else response.calculate_content_length()
+    if length is not None and length < current_app.config['COMPRESSION_MIN_SIZE']:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = compress.negotiate(request.accept_encodings)
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress.compress_chunks(response.response, encoding)
+        # The length of the compressed stream is not known until it has been sent.
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(compress.compress(response.get_data(), encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
 
 
 # Forms section
+def phone_number(form, field):
+    if normalize_phone(field.data) is None:
+        raise ValidationError('Номер телефона, например +7 912 345-67-89')
+
+
+def new_idempotency_key():
+    return uuid.uuid4().hex
+
+
 class BookingForm(FlaskForm):
+    # The slot travels with the form instead of being kept on the server between requests. The CSRF token does not
+    # cover these fields and a visitor can change them: sent() checks them again and book_slot() takes the slot only
+    # if free_mask still has it.
+    teacher_id = HiddenField(validators=[validators.input_required()])
+    day = HiddenField(validators=[validators.input_required()])
+    time = HiddenField(validators=[validators.input_required()])
     name = StringField('Вас зовут', validators=[validators.input_required()])
-    phone = StringField('Ваш телефон', validators=[validators.input_required()])
+    phone = StringField('Ваш телефон', validators=[validators.input_required(), phone_number])
+    # A new key every time the form is shown; see "Intake".
+    idempotency_key = HiddenField(default=new_idempotency_key, validators=[validators.length(max=64)])
 
 class MessageForm(FlaskForm):
     name = StringField('Васс зовут', validators=[validators.input_required()])
-    phone = StringField('Ваш телефон', validators=[validators.input_required()])
+    phone = StringField('Ваш телефон', validators=[validators.input_required(), phone_number])
     message = StringField('сообщение', validators=[validators.input_required()])
+    idempotency_key = HiddenField(default=new_idempotency_key, validators=[validators.length(max=64)])
 
 class RequestForm(FlaskForm):
     goal = RadioField('Какая цель заниятий?', choices=[("travel", "Для путешествий"),
@@ -117,123 +1517,374 @@ class RequestForm(FlaskForm):
                                                             ("3-5", "3-5 часов в неделю"),
                                                             ("5-7", "5-7 часов в неделю"),
                                                             ("7-9", "7-9 часов в неделю")])
+    daytime = RadioField('Когда удобно заниматься?', choices=[("any", "В любое время"),
+                                                              ("morning", "Утром"),
+                                                              ("day", "Днем"),
+                                                              ("evening", "Вечером")], default="any")
+    max_price = IntegerField('Ставка до (в час)', validators=[validators.optional(), validators.number_range(min=0)])
+    name = StringField('Вас зовут', validators=[validators.input_required()])
+    phone = StringField('Ваш телефон', validators=[validators.input_required(), phone_number])
+
+class ReviewForm(FlaskForm):
+    rating = RadioField('Ваша оценка', choices=[(5, '5 — отлично'), (4, '4'), (3, '3'), (2, '2'), (1, '1')], coerce=int)
     name = StringField('Вас зовут', validators=[validators.input_required()])
-    phone = StringField('Ваш телефон', validators=[validators.input_required()])
+    phone = StringField('Телефон, с которого вы записывались', validators=[validators.input_required(), phone_number])
+    text = StringField('Отзыв', validators=[validators.optional(), validators.length(max=2000)])
 
 # Routes section
-@app.route('/')
+GOAL_PAGE_SIZE = 20
+# sort parameter -> direction; ties are broken by id in the same direction (the same order as the API's, whose
+# ORDER BY walks one of the (rating, id) / (price, id) indexes, forwards or backwards).
+GOAL_PAGE_SORTS = {'rating': 'desc', 'price': 'asc'}
+
+
+def make_cursor(value, id):
+    return '{}:{}'.format(value, id)
+
+
+def parse_cursor(cursor):
+    # Broken cursors just start from the first page.
+    try:
+        value, id = cursor.rsplit(':', 1)
+        return float(value), int(id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def keyset_page(query, sort_column, direction, after):
+    # Orders query by sort_column and id in direction and starts after the (value, id) cursor, if any.
+    if after is not None:
+        after_value, after_id = after
+        if direction == 'desc':
+            query = query.filter(db.or_(sort_column < after_value,
+                                        db.and_(sort_column == after_value, Teacher.id < after_id)))
+        else:
+            query = query.filter(db.or_(sort_column > after_value,
+                                        db.and_(sort_column == after_value, Teacher.id > after_id)))
+    if direction == 'desc':
+        return query.order_by(sort_column.desc(), Teacher.id.desc())
+    return query.order_by(sort_column, Teacher.id)
+
+
+def has_goal(goal_id):
+    # Checked per teacher against ix_teachers_goals_teacher_goal while walking a sort index.
+    return db.exists().where(db.and_(teachers_goals.c.teacher_id == Teacher.id,
+                                     teachers_goals.c.goal_id == goal_id))
+
+
+INDEX_TEACHERS = 6
+# Cards show about|truncate(300), which keeps texts up to 305 characters as they are,
+# so the first 306 characters give exactly the same card as the full text.
+CARD_ABOUT_LENGTH = 306
+# Lessons start every two hours.
+SLOT_HOURS = 2
+# The slots booking() accepts: free_mask also covers weekends and evenings, which cannot be booked.
+BOOKABLE_MASK = sum(availability.slot_bit(day, time) for day in days for time in times.values())
+
+
+def free_today_mask(now):
+    # Bookable slots of today that have not finished yet; none on weekends.
+    return availability.day_mask(availability.DAYS[now.weekday()], now.hour - SLOT_HOURS + 1) & BOOKABLE_MASK
+
+
+def free_ids(ids, mask):
+    # Those of ids that are free in one of the slots of mask, by free_mask: the slot index may not have seen every
+    # booking yet.
+    return set(id for id, in db.session.query(Teacher.id).filter(Teacher.id.in_(ids), free_in(mask)))
+
+
+def free_rows(catalog, rows, mask, count):
+    # The first count catalog rows of teachers free in mask, in order, checked in SQL a page at a time.
+    found = []
+    start = 0
+    while len(found) < count and start < len(rows):
+        chunk = rows[start:start + count - len(found)]
+        start += len(chunk)
+        ids = catalog.ids[chunk].tolist()
+        free = free_ids(ids, mask)
+        found.extend(row for row, id in zip(chunk.tolist(), ids) if id in free)
+    return found
+
+
+def random_free_teachers(mask):
+    # A random sample of teachers free in one of the slots of mask, drawn from the slot index.
+    # Twice as many are drawn as shown, in case the index has not seen some bookings yet.
+    index = get_slot_index()
+    ids = index.ids(index.free(mask))
+    picked = [int(ids[number]) for number in sample(range(len(ids)), min(len(ids), INDEX_TEACHERS * 2))]
+    if not picked:
+        return []
+    free = free_ids(picked, mask)
+    catalog = get_catalog()
+    teachers = [catalog.teacher(id) for id in picked if id in free]
+    return [teacher for teacher in teachers if teacher is not None][:INDEX_TEACHERS]
+
+
+# The sample of free teachers changes with time, so the index page is kept for a shorter while.
+INDEX_PAGE_TTL = 60
+
+
+@site.route('/')
+@db.read_only
+@cached_page(ttl=INDEX_PAGE_TTL, query_args=('day', 'time'))
 def main():
-    all_goals = []
-    teachers_for_index = []
-
-    # Dictionaries are added to all_goals and all_teachers manually because .__dict__ is not working for some reason.
-    # And, I could not access sqlalchemy model objects from templates, therefore lists and dictionaries.
-    goals_from_db = db.session.query(Goal).all()
-    for goal in goals_from_db:
-        all_goals.append({'name_en': goal.name_en, 'name_ru': goal.name_ru})
-
-    # Could not use func.random() from sqlalchemy, therefore shuffle() from python.
-    teachers_from_db = db.session.query(Teacher).all()
-    shuffle(teachers_from_db)
-    six_random_teachers = teachers_from_db[:6]
-
-    for teacher in six_random_teachers:
-        teachers_for_index.append({'id': str(teacher.id),
-                                   'name': teacher.name,
-                                   'rating': teacher.rating,
-                                   'price': teacher.price,
-                                   'about': teacher.about})
-
-    output = render_template('index.html',
-                             links=links,
-                             goals=all_goals,
-                             teachers=teachers_for_index)
-    return output
+    cache_tags('catalog')
+    all_goals = list(get_catalog().goals.values())
+
+    # Either the slot asked for or whatever is left of today.
+    slot = slot_filter()
+    if slot is not None:
+        mask = availability.slot_bit(slot[0], times[slot[1]])
+    else:
+        mask = free_today_mask(datetime.now())
+    return stream_page('index.html',
+                       links=links,
+                       goals=all_goals,
+                       cards=teacher_cards(random_free_teachers(mask)),
+                       days=days,
+                       times=times,
+                       slot=slot)
 
 
-@app.route('/goals/<goal>/')
+@site.route('/goals/<goal>/')
+@db.read_only
+@cached_page(query_args=('sort', 'after', 'day', 'time'))
 def goals(goal):
-    goal_from_db = db.session.query(Goal).filter(Goal.name_en == goal).first()
-    goal_ru_from_db = goal_from_db.name_ru.lower()
-    # For some reason, db.in_() is not working, therefore filtering by goal in teacher.goals is done manually.
-    teachers_with_goal = []
-    all_teachers = db.session.query(Teacher).all()
-    for this_teacher in all_teachers:
-        if goal_from_db in this_teacher.goals:
-            # .__dict__ is also not working, so dictionary is also done manually.
-            teachers_with_goal.append({'id': str(this_teacher.id),
-                                       'name': this_teacher.name,
-                                       'rating': this_teacher.rating,
-                                       'price': this_teacher.price,
-                                       'about': this_teacher.about})
-    output = render_template('goal.html',
-                             links=links,
-                             teachers_with_goal=teachers_with_goal,
-                             goal=goal,
-                             goal_ru=goal_ru_from_db)
-    return output
+    cache_tags('catalog')
+    catalog = get_catalog()
+    goal_record = catalog.goals_by_name.get(goal)
+    if goal_record is None:
+        abort(404)
+    cache_tags('goal:{}'.format(goal_record.id))
+
+    sort = request.args.get('sort', 'rating')
+    if sort not in GOAL_PAGE_SORTS:
+        sort = 'rating'
+
+    # Keyset pagination: "after" is the sort value and id of the last teacher on the previous page.
+    # The snapshot has the goal's teachers in page order, so the page is a slice after the cursor.
+    candidates = catalog.goal_rows(goal_record, sort, parse_cursor(request.args.get('after')))
+
+    # ?day=&time= keeps teachers free in that slot: the slot index narrows the walk down, SQL has the last word.
+    slot = slot_filter()
+    free_total = None
+    if slot is not None:
+        bit = availability.slot_bit(slot[0], times[slot[1]])
+        index = get_slot_index()
+        free = index.ids(index.free(bit, goal_record.id))
+        free_total = len(free)
+        # One extra row tells whether there is a next page.
+        page = free_rows(catalog, catalog.rows_of(candidates, free), bit, GOAL_PAGE_SIZE + 1)
+    else:
+        page = candidates[:GOAL_PAGE_SIZE + 1].tolist()
+
+    rows = [catalog.record(row) for row in page]
+    next_cursor = None
+    if len(rows) > GOAL_PAGE_SIZE:
+        rows = rows[:GOAL_PAGE_SIZE]
+        next_cursor = make_cursor(getattr(rows[-1], sort), rows[-1].id)
+
+    return stream_page('goal.html',
+                       links=links,
+                       cards=teacher_cards(rows),
+                       goal=goal,
+                       goal_ru=goal_record.name_ru.lower(),
+                       stats=goal_record,
+                       sort=sort,
+                       next_cursor=next_cursor,
+                       days=days,
+                       times=times,
+                       slot=slot,
+                       free_total=free_total)
 
-@app.route('/profiles/<int:id>/')
+@site.route('/profiles/<int:id>/')
+@db.read_only
+@cached_page()
 def profiles(id):
-    profile_goals = []
-    teacher = db.session.query(Teacher).filter(Teacher.id == id).first()
-    for goal in teacher.goals:
-        profile_goals.append(goal.name_ru)
-    # For some reason, json.dumps makes it Python dict string rather than JSON string.
-    # Therefore, json.loads does not work (expects double quotes), but eval does.
-    free = eval(teacher.free)
+    cache_tags('catalog', 'teacher:{}'.format(id))
+    teacher = load_profile(id)
+    if teacher is None:
+        abort(404)
 
     output = render_template('profile.html',
                              links=links,
                              teacher=teacher,
                              id=str(teacher.id),
-                             goals=profile_goals,
-                             free=free,
-                             days=days,
-                             times=times)
+                             goals=teacher.goals,
+                             schedule=teacher_schedule(teacher))
     return output
 
-@app.route('/search?s=aaaa')
+SEARCH_PAGE_SIZE = 20
+
+
+@site.route('/search')
+@db.read_only
 def search():
-    return 'Здесь будет поиск'
+    query = request.args.get('s', '').strip()
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        page = 1
+
+    connection = db.session.connection()
+    ids, total = search_index.search(connection, query, lambda: teacher_documents(connection),
+                                     offset=(page - 1) * SEARCH_PAGE_SIZE, limit=SEARCH_PAGE_SIZE)
+
+    cards = []
+    if ids:
+        rows = db.session.query(Teacher.id, Teacher.name, Teacher.rating, Teacher.price, Teacher.version,
+                                db.func.substr(Teacher.about, 1, CARD_ABOUT_LENGTH).label('about'))\
+            .filter(Teacher.id.in_(ids))\
+            .all()
+        rows_by_id = {row.id: row for row in rows}
+        # Keep the search ranking.
+        for id in ids:
+            if id in rows_by_id:
+                cards.append(teacher_card(rows_by_id[id]))
+
+    output = render_template('search.html',
+                             links=links,
+                             query=query,
+                             cards=cards,
+                             total=total,
+                             page=page,
+                             has_next=page * SEARCH_PAGE_SIZE < total)
+    return output
 
-@app.route('/request')
+@site.route('/request', methods=['GET', 'POST'])
+@throttled
 def reqs():
 
     form = RequestForm()
+    teachers_matched = None
+
+    if form.validate_on_submit():
+        phone = normalize_phone(form.phone.data)
+        subject = lead_subject(form.goal.data, form.duration.data, form.daytime.data, form.max_price.data,
+                               datetime.now().date().isoformat())
+        add_lead('request', form.name.data, phone, subject)
+        job_queue.enqueue('request', {'name': form.name.data, 'phone': phone, 'goal': form.goal.data,
+                                      'duration': form.duration.data, 'daytime': form.daytime.data,
+                                      'max_price': form.max_price.data})
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # The same request again today: the matches are shown, the school is not told twice.
+            db.session.rollback()
+
+        teachers_matched = []
+        goal_from_db = db.session.query(Goal).filter(Goal.name_en == form.goal.data).first()
+        if goal_from_db is not None:
+            daypart = form.daytime.data if form.daytime.data != 'any' else None
+            ids = get_matcher().match(goal_from_db.id,
+                                      DURATION_SLOTS[form.duration.data],
+                                      max_price=form.max_price.data,
+                                      daypart=daypart,
+                                      limit=MATCH_LIMIT)
+            rows = db.session.query(Teacher.id, Teacher.name, Teacher.rating, Teacher.price,
+                                    db.func.substr(Teacher.about, 1, CARD_ABOUT_LENGTH).label('about'))\
+                .filter(Teacher.id.in_(ids))\
+                .all()
+            rows_by_id = {row.id: row for row in rows}
+            # Keep the matcher's ranking.
+            for id in ids:
+                if id in rows_by_id:
+                    teacher = rows_by_id[id]
+                    teachers_matched.append({'id': str(teacher.id),
+                                             'name': teacher.name,
+                                             'rating': teacher.rating,
+                                             'price': teacher.price,
+                                             'about': teacher.about})
 
     output = render_template('pick.html',
                              links=links,
-                             form=form)
+                             form=form,
+                             teachers=teachers_matched)
     return output
 
-@app.route('/booking/<id>/<day>/<time>', methods=['GET'])
-def booking(id, day, time):
-    with open ('request.json', 'w', encoding='utf-8') as r:
-        json.dump({'day': days[day], 'time': times[time]}, r)
-
-    teacher_from_db = db.session.query(Teacher).filter(Teacher.id == int(id)).first()
-    teacher_for_booking = {'id': id,
-                           'name': teacher_from_db.name}
-
-    form = BookingForm()
+def render_booking(teacher, form, taken=False):
+    teacher_for_booking = {'id': str(teacher.id),
+                           'name': teacher.name}
 
     output = render_template('booking.html',
                              links=links,
                              teacher=teacher_for_booking,
                              form=form,
-                             day_ru=days[day],
-                             time=times[time])
+                             day_ru=days[form.day.data],
+                             time=times[form.time.data],
+                             taken=taken)
     return output
 
-@app.route('/message/<id>')
+
+def book_slot(teacher_id, day, time, name, phone, idempotency_key=None):
+    # Takes the slot out of the teacher's free_mask and adds the booking and its lead in one transaction.
+    # False if the slot is not free: either the schedule says so or someone (maybe this very form) has just booked it.
+    bit = availability.slot_bit(day, times[time])
+    taken = db.session.query(Teacher)\
+        .filter(Teacher.id == teacher_id, free_in(bit))\
+        .update({Teacher.free_mask: Teacher.free_mask.op('&')(~bit), Teacher.version: Teacher.version + 1},
+                synchronize_session=False)
+    if not taken:
+        db.session.rollback()
+        return False
+    db.session.add(Booking(teacher_id=teacher_id, day=day, time=time, name=name, phone=phone))
+    add_lead('booking', name, phone, lead_subject('teacher', teacher_id, day, time), idempotency_key, teacher_id)
+    job_queue.enqueue('booking', {'teacher_id': teacher_id, 'day': day, 'time': time, 'name': name, 'phone': phone})
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # ix_bookings_teacher_slot (or a lead index): a concurrent request booked the same slot first.
+        db.session.rollback()
+        return False
+    page_cache.invalidate('teacher:{}'.format(teacher_id))
+    if matcher is not None:
+        matcher.take(teacher_id, day, times[time])
+    if slot_index is not None:
+        slot_index.take(teacher_id, day, times[time])
+    return True
+
+
+@site.route('/booking/<int:id>/<day>/<time>', methods=['GET'])
+@db.read_only
+def booking(id, day, time):
+    if day not in days or time not in times:
+        abort(404)
+    teacher = load_profile(id)
+    if teacher is None:
+        abort(404)
+
+    form = BookingForm(teacher_id=id, day=day, time=time)
+    taken = not teacher.free_mask & availability.slot_bit(day, times[time])
+    return render_booking(teacher, form, taken)
+
+@site.route('/message/<int:id>', methods=['GET', 'POST'])
+@throttled
 def message(id):
 
-    teacher_from_db = db.session.query(Teacher).filter(Teacher.id == int(id)).first()
-    teacher_for_message = {'id': str(teacher_from_db.id),
-                           'name': teacher_from_db.name}
+    teacher = get_catalog().teacher(id)
+    if teacher is None:
+        abort(404)
+    teacher_for_message = {'id': str(teacher.id),
+                           'name': teacher.name}
 
     form = MessageForm()
+    if form.validate_on_submit():
+        phone = normalize_phone(form.phone.data)
+        subject = lead_subject('teacher', teacher.id, datetime.now().date().isoformat(),
+                               hashlib.sha1(form.message.data.encode()).hexdigest())
+        add_lead('message', form.name.data, phone, subject, form.idempotency_key.data, teacher.id)
+        job_queue.enqueue('message', {'teacher_id': teacher.id, 'name': form.name.data, 'phone': phone,
+                                      'message': form.message.data})
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Sent before (same form or same text from the same phone today): it is already queued.
+            db.session.rollback()
+        output = render_template('sent.html',
+                                 links=links,
+                                 subject='Сообщение',
+                                 name=form.name.data,
+                                 phone=phone)
+        return output
 
     output = render_template('message.html',
                              links=links,
@@ -241,24 +1892,229 @@ def message(id):
                              form=form)
     return output
 
-@app.route('/sent/', methods=['GET'])
+@site.route('/profiles/<int:id>/review', methods=['GET', 'POST'])
+@throttled
+def review(id):
+    teacher = get_catalog().teacher(id)
+    if teacher is None:
+        abort(404)
+    teacher_for_review = {'id': str(teacher.id),
+                          'name': teacher.name}
+
+    form = ReviewForm()
+    done = False
+    if form.validate_on_submit():
+        phone = normalize_phone(form.phone.data)
+        booked = db.session.query(db.exists().where(db.and_(Booking.teacher_id == teacher.id,
+                                                            Booking.phone == phone))).scalar()
+        if not booked:
+            form.phone.errors.append('Отзыв можно оставить после записи к этому преподавателю')
+        else:
+            try:
+                add_review(teacher.id, form.name.data, phone, form.rating.data, form.text.data)
+                db.session.commit()
+                done = True
+            except IntegrityError:
+                db.session.rollback()
+                form.phone.errors.append('С этого номера отзыв уже оставлен')
+
+    output = render_template('review.html',
+                             links=links,
+                             teacher=teacher_for_review,
+                             form=form,
+                             done=done)
+    return output
+
+@site.route('/sent/', methods=['POST'])
+@throttled
 def sent():
-    name = request.args.get('name') # for some reason, request.form.get(item) and request.form[item] don't work.
-    phone = request.args.get('phone')
-    with open('request.json', encoding='utf-8') as r:
-        jsonized_data = json.load(r)
-    day = jsonized_data['day']
-    time = jsonized_data['time']
-
-    with open('request.json', 'w', encoding='utf-8') as r:
-        json.dump({'day': day, 'time': time, 'name': name, 'phone': phone}, r)
+    form = BookingForm()
+    # A slot that did not come from a booking page.
+    if not (form.teacher_id.data or '').isdigit() or form.day.data not in days or form.time.data not in times:
+        abort(400)
+    teacher = get_catalog().teacher(int(form.teacher_id.data))
+    if teacher is None:
+        abort(400)
+    if not form.validate_on_submit():
+        return render_booking(teacher, form)
+
+    day = form.day.data
+    time = form.time.data
+    phone = normalize_phone(form.phone.data)
+    idempotency_key = form.idempotency_key.data
+    if not book_slot(teacher.id, day, time, form.name.data, phone, idempotency_key):
+        # Unless the slot went to this form, submitted twice, or to the same phone.
+        if not lead_exists('booking', phone, lead_subject('teacher', teacher.id, day, time), idempotency_key):
+            return render_booking(teacher, form, taken=True)
+
     output = render_template('sent.html',
                              links=links,
-                             name=name,
+                             subject='Пробный урок',
+                             name=form.name.data,
                              phone=phone,
-                             day=day,
-                             time=time)
+                             day=days[day],
+                             time=times[time])
     return output
 
+# API section
+# /api/v1: JSON for the mobile client and partners. Rows are read as plain tuples and turned into dicts field by field;
+# ?fields=id,name,goals picks the fields, lists are paged with the same keyset cursors as goal pages,
+# and /api/v1/teachers/export streams the whole catalog as NDJSON in batches, so memory use does not grow with it.
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+API_EXPORT_BATCH_SIZE = 1000
+API_SORTS = dict(GOAL_PAGE_SORTS, id='asc')
+API_DEFAULT_FIELDS = ('id', 'name', 'rating', 'price', 'goals')
+# Goal names of the current teacher, as "travel,work", read through ix_teachers_goals_teacher_goal.
+teacher_goal_names = select([database.group_concat(Goal.name_en, ',')])\
+    .select_from(teachers_goals.join(Goal.__table__))\
+    .where(teachers_goals.c.teacher_id == Teacher.id)\
+    .scalar_subquery()
+# field -> (column, conversion of the value for JSON)
+API_FIELDS = {'id': (Teacher.id, None),
+              'name': (Teacher.name, None),
+              'about': (Teacher.about, None),
+              'rating': (Teacher.rating, None),
+              'price': (Teacher.price, None),
+              'goals': (teacher_goal_names, lambda names: names.split(',') if names else []),
+              'free': (Teacher.free_mask, availability.unpack_free)}
+
+
+def api_error(status, message):
+    response = jsonify({'error': message})
+    response.status_code = status
+    return response
+
+
+def api_fields():
+    # The fields asked for in ?fields=, or None if one of them is unknown.
+    fields = request.args.get('fields')
+    if not fields:
+        return API_DEFAULT_FIELDS
+    fields = tuple(field.strip() for field in fields.split(',') if field.strip())
+    if not fields or any(field not in API_FIELDS for field in fields):
+        return None
+    return fields
+
+
+def api_query(fields, *leading):
+    # Query for the leading columns (used for paging, not returned) followed by the fields.
+    return db.session.query(*(list(leading) + [API_FIELDS[field][0].label(field) for field in fields]))
+
+
+def api_record(fields, values):
+    record = {}
+    for field, value in zip(fields, values):
+        convert = API_FIELDS[field][1]
+        record[field] = convert(value) if convert is not None and value is not None else value
+    return record
+
+
+def api_goal_id(name):
+    # (goal id or None, error response or None) for ?goal=.
+    if not name:
+        return None, None
+    goal_id = db.session.query(Goal.id).filter(Goal.name_en == name).scalar()
+    if goal_id is None:
+        return None, api_error(404, 'unknown goal')
+    return goal_id, None
+
+
+@site.route('/api/v1/teachers')
+@db.read_only
+def api_teachers():
+    fields = api_fields()
+    if fields is None:
+        return api_error(400, 'fields must be some of: ' + ', '.join(sorted(API_FIELDS)))
+    sort = request.args.get('sort', 'id')
+    if sort not in API_SORTS:
+        return api_error(400, 'sort must be one of: ' + ', '.join(sorted(API_SORTS)))
+    limit = min(max(request.args.get('limit', API_PAGE_SIZE, type=int), 1), API_MAX_PAGE_SIZE)
+    goal_id, error = api_goal_id(request.args.get('goal'))
+    if error is not None:
+        return error
+
+    sort_column = getattr(Teacher, sort)
+    query = api_query(fields, Teacher.id, sort_column)
+    if goal_id is not None:
+        query = query.filter(has_goal(goal_id))
+    query = keyset_page(query, sort_column, API_SORTS[sort], parse_cursor(request.args.get('after')))
+
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = make_cursor(rows[-1][1], rows[-1][0])
+    return jsonify({'data': [api_record(fields, row[2:]) for row in rows],
+                    'next': next_cursor})
+
+
+@site.route('/api/v1/teachers/<int:id>')
+@db.read_only
+def api_teacher(id):
+    fields = api_fields()
+    if fields is None:
+        return api_error(400, 'fields must be some of: ' + ', '.join(sorted(API_FIELDS)))
+    row = api_query(fields).filter(Teacher.id == id).first()
+    if row is None:
+        return api_error(404, 'teacher not found')
+    return jsonify({'data': api_record(fields, row)})
+
+
+@site.route('/api/v1/teachers/<int:id>/availability')
+@db.read_only
+def api_availability(id):
+    free_mask = db.session.query(Teacher.free_mask).filter(Teacher.id == id).scalar()
+    if free_mask is None:
+        return api_error(404, 'teacher not found')
+    slots = [{'day': day, 'time': time}
+             for day in availability.DAYS for time in availability.TIMES
+             if free_mask & availability.slot_bit(day, time)]
+    return jsonify({'data': {'id': id, 'free': slots}})
+
+
+@site.route('/api/v1/goals')
+@db.read_only
+def api_goals():
+    rows = db.session.query(Goal.name_en, Goal.name_ru, GoalStats.teacher_count, GoalStats.price_sum,
+                            GoalStats.review_count, GoalStats.rating_sum)\
+        .outerjoin(GoalStats, GoalStats.goal_id == Goal.id)\
+        .order_by(Goal.id)\
+        .all()
+    return jsonify({'data': [{'name_en': row.name_en,
+                              'name_ru': row.name_ru,
+                              'teachers': row.teacher_count or 0,
+                              'average_price': round(row.price_sum / row.teacher_count, 2) if row.teacher_count else None,
+                              'reviews': row.review_count or 0,
+                              'average_rating': round(row.rating_sum / row.review_count, 2) if row.review_count else None}
+                             for row in rows]})
+
+
+@site.route('/api/v1/teachers/export')
+@db.read_only
+def api_export():
+    fields = api_fields()
+    if fields is None:
+        return api_error(400, 'fields must be some of: ' + ', '.join(sorted(API_FIELDS)))
+    goal_id, error = api_goal_id(request.args.get('goal'))
+    if error is not None:
+        return error
+
+    def lines():
+        # Keyset batches in id order: at most API_EXPORT_BATCH_SIZE rows are held at a time.
+        last_id = 0
+        while True:
+            query = api_query(fields, Teacher.id).filter(Teacher.id > last_id)
+            if goal_id is not None:
+                query = query.filter(has_goal(goal_id))
+            rows = query.order_by(Teacher.id).limit(API_EXPORT_BATCH_SIZE).all()
+            if rows:
+                yield ''.join(json.dumps(api_record(fields, row[1:]), ensure_ascii=False) + '\n' for row in rows)
+            if len(rows) < API_EXPORT_BATCH_SIZE:
+                return
+            last_id = rows[-1][0]
+
+    return Response(stream_with_context(lines()), mimetype='application/x-ndjson')
+
 if __name__ == '__main__':
-    app.run()
+    create_app().run()
@@ -0,0 +1,166 @@
+import base64
+import hashlib
+import io
+import json
+import logging
+import os
+import urllib.request
+
+# Static files under content-hashed names.
+# "flask assets build" (run when the slug is built, see bin/post_compile) copies every file of static/ to static/dist/
+# as name.<hash>.ext, makes square card and profile thumbnails of the teacher photos in static/photos/<teacher id>.png,
+# PNG and WebP, and writes static/dist/manifest.json. A hashed file never changes, so /assets/ serves it with a one-year
+# immutable Cache-Control: browsers keep it until a new build gives the page a new URL.
+# Without a build (development) pages link the files in static/ as they are.
+# Thumbnails need Pillow (in requirements.txt); without it the photos are hashed as they are and used for every size.
+
+logger = logging.getLogger('tinysteps.assets')
+
+DIST = 'dist'
+MAX_AGE = 365 * 24 * 3600
+# Side of the square thumbnail in pixels, per place it is shown (never larger than the photo itself).
+THUMBNAILS = {'card': 240, 'profile': 480}
+PHOTOS = 'photos'
+# Teachers without a photo get this one.
+FALLBACK_AVATAR = 'avatar.svg'
+# Third-party files kept in static/vendor/ so that pages do not wait for another host ("flask assets vendor" fetches
+# them): path -> (URL, subresource integrity hash the download has to match).
+VENDOR = {'vendor/bootstrap.min.css': ('https://stackpath.bootstrapcdn.com/bootstrap/4.3.1/css/bootstrap.min.css',
+                                       'sha384-ggOyR0iXCbMQv3Xipma34MD+dH/1fQ784/j6cY/iJTQUOhcWr7x9JvoRxT2MZw1T')}
+
+
+def hashed_name(name, data):
+    base, extension = os.path.splitext(name)
+    return '{}.{}{}'.format(base, hashlib.sha256(data).hexdigest()[:12], extension)
+
+
+def source_files(static_folder):
+    # Paths relative to static_folder, with '/', leaving out the build output.
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder and DIST in dirs:
+            dirs.remove(DIST)
+        for file_name in files:
+            path = os.path.relpath(os.path.join(root, file_name), static_folder)
+            yield path.replace(os.sep, '/')
+
+
+def thumbnail(path, pixels, image_format):
+    # None without Pillow.
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+    with Image.open(path) as image:
+        pixels = min(pixels, *image.size)
+        image = ImageOps.fit(image, (pixels, pixels), Image.LANCZOS)
+        output = io.BytesIO()
+        if image_format == 'webp':
+            image.save(output, format='WEBP', quality=80, method=6)
+        else:
+            image.save(output, format='PNG', optimize=True)
+        return output.getvalue()
+
+
+def build(static_folder):
+    # Returns the manifest: {'files': {source path: hashed path}, 'photos': {teacher id: {size: {'webp': hashed path,
+    # 'img': hashed path}}}}, 'img' being a PNG thumbnail or, without Pillow, the photo itself.
+    dist = os.path.join(static_folder, DIST)
+    manifest = {'files': {}, 'photos': {}}
+
+    def write(name, data):
+        hashed = hashed_name(name, data)
+        path = os.path.join(dist, hashed)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as output:
+                output.write(data)
+        return hashed
+
+    for name in sorted(source_files(static_folder)):
+        with open(os.path.join(static_folder, name), 'rb') as source:
+            manifest['files'][name] = write(name, source.read())
+
+    for name in sorted(manifest['files']):
+        directory, file_name = os.path.split(name)
+        teacher_id = os.path.splitext(file_name)[0]
+        if directory != PHOTOS or not teacher_id.isdigit():
+            continue
+        sizes = manifest['photos'][teacher_id] = {}
+        for size, pixels in THUMBNAILS.items():
+            sizes[size] = {}
+            for image_format, key in (('webp', 'webp'), ('png', 'img')):
+                data = thumbnail(os.path.join(static_folder, name), pixels, image_format)
+                if data is not None:
+                    sizes[size][key] = write('{}/{}-{}.{}'.format(PHOTOS, teacher_id, size, image_format), data)
+            if not sizes[size]:
+                sizes[size] = {'img': manifest['files'][name]}
+    if manifest['photos'] and not any('webp' in sizes['card'] for sizes in manifest['photos'].values()):
+        logger.warning('Pillow is not installed: photos are used at their original size, without WebP.')
+
+    # Written last and replaced in one step, so a running app never reads half a manifest.
+    temporary = os.path.join(dist, 'manifest.json.tmp')
+    with open(temporary, 'w') as output:
+        json.dump(manifest, output, indent=1, sort_keys=True)
+    os.replace(temporary, os.path.join(dist, 'manifest.json'))
+    return manifest
+
+
+def fetch_vendor(static_folder):
+    # Downloads every VENDOR file that is missing and checks it against its integrity hash.
+    fetched = []
+    for name, (url, integrity) in VENDOR.items():
+        path = os.path.join(static_folder, name)
+        if os.path.exists(path):
+            continue
+        with urllib.request.urlopen(url, timeout=30) as response:
+            data = response.read()
+        algorithm, expected = integrity.split('-', 1)
+        if base64.b64encode(hashlib.new(algorithm, data).digest()).decode() != expected:
+            raise ValueError('{} does not match its integrity hash'.format(url))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as output:
+            output.write(data)
+        fetched.append(name)
+    return fetched
+
+
+class Assets:
+    # URLs of static files for templates: asset_url('check.png'), photo_urls(teacher id, 'card').
+    def __init__(self):
+        self.files = {}
+        self.photos = {}
+
+    def load(self, static_folder):
+        path = os.path.join(static_folder, DIST, 'manifest.json')
+        if os.path.exists(path):
+            with open(path) as manifest_file:
+                manifest = json.load(manifest_file)
+            self.files = {name: '/assets/' + hashed for name, hashed in manifest['files'].items()}
+            self.photos = {int(teacher_id): {size: {key: '/assets/' + hashed for key, hashed in formats.items()}
+                                             for size, formats in sizes.items()}
+                           for teacher_id, sizes in manifest['photos'].items()}
+            return
+        self.files = {name: '/static/' + name for name in source_files(static_folder)}
+        self.photos = {}
+        for name, url in self.files.items():
+            directory, file_name = os.path.split(name)
+            teacher_id = os.path.splitext(file_name)[0]
+            if directory == PHOTOS and teacher_id.isdigit():
+                self.photos[int(teacher_id)] = {size: {'img': url} for size in THUMBNAILS}
+
+    def url(self, name):
+        if name in self.files:
+            return self.files[name]
+        if name in VENDOR:
+            return VENDOR[name][0]
+        return '/static/' + name
+
+    def has(self, name):
+        return name in self.files
+
+    def photo_urls(self, teacher_id, size):
+        # {'img': url} and, when built with Pillow, {'webp': url} too; the fallback avatar for teachers without a photo.
+        sizes = self.photos.get(teacher_id)
+        if sizes is None:
+            return {'img': self.url(FALLBACK_AVATAR)}
+        return sizes[size]
@@ -0,0 +1,65 @@
+import ast
+import json
+
+# A teacher's weekly schedule packed into one integer: 7 days x 8 lesson times = 56 bits.
+# Bit number is day index * 8 + time index, so "free on tue at 10:00" is a single bit test,
+# both in Python and in SQL (free_mask & bit).
+DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+TIMES = ['8:00', '10:00', '12:00', '14:00', '16:00', '18:00', '20:00', '22:00']
+
+
+def slot_bit(day, time):
+    return 1 << (DAYS.index(day) * len(TIMES) + TIMES.index(time))
+
+
+# (day, time) -> slot_bit(day, time), for packing whole schedules.
+SLOT_BITS = {(day, time): slot_bit(day, time) for day in DAYS for time in TIMES}
+
+
+def day_mask(day, from_hour=0):
+    # All slots of the day starting at from_hour or later.
+    mask = 0
+    for time in TIMES:
+        if int(time.split(':')[0]) >= from_hour:
+            mask |= slot_bit(day, time)
+    return mask
+
+
+def time_mask(time):
+    # The same time on every day of the week.
+    mask = 0
+    for day in DAYS:
+        mask |= slot_bit(day, time)
+    return mask
+
+
+def pack_free(free):
+    # {'mon': {'8:00': True, ...}, ...} -> bitmap. Unknown days and times are ignored.
+    mask = 0
+    for day, slots in free.items():
+        for time, is_free in slots.items():
+            if is_free:
+                mask |= SLOT_BITS.get((day, time), 0)
+    return mask
+
+
+def unpack_free(mask):
+    # Bitmap -> the same dictionary shape as in teachers.json, for templates.
+    free = {}
+    for day in DAYS:
+        free[day] = {}
+        for time in TIMES:
+            free[day][time] = bool(mask & slot_bit(day, time))
+    return free
+
+
+def count_slots(mask):
+    return bin(mask).count('1')
+
+
+def parse_free(free):
+    # Old rows hold the schedule as a JSON string; some were written as a Python dict string, hence the fallback.
+    try:
+        return json.loads(free)
+    except ValueError:
+        return ast.literal_eval(free)
@@ -0,0 +1,51 @@
+import argparse
+import json
+import random
+
+# Synthetic teachers.json-shaped catalogs of any size, built from the real teachers.json:
+# names, about texts and goals are mixed and names are numbered so they stay unique.
+
+DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+TIMES = ['8:00', '10:00', '12:00', '14:00', '16:00', '18:00', '20:00', '22:00']
+PRICES = range(500, 3100, 100)
+
+
+def generate_teachers(count, source='teachers.json', goals='goals.json', seed=0):
+    # Yields (id, teacher) pairs, so even 100k teachers are never in memory at once.
+    rng = random.Random(seed)
+    with open(source, encoding='utf-8') as f:
+        samples = list(json.load(f).values())
+    with open(goals, encoding='utf-8') as f:
+        goal_names = list(json.load(f))
+    for id in range(1, count + 1):
+        sample = rng.choice(samples)
+        free = {}
+        for day in DAYS:
+            free[day] = {}
+            for time in TIMES:
+                free[day][time] = rng.random() < 0.3
+        yield str(id), {'name': '{} #{}'.format(sample['name'], id),
+                        'about': rng.choice(samples)['about'],
+                        'rating': round(rng.uniform(3.5, 5.0), 1),
+                        'price': rng.choice(PRICES),
+                        'goals': rng.sample(goal_names, rng.randint(1, len(goal_names))),
+                        'free': free}
+
+
+def write_teachers(path, count, source='teachers.json', goals='goals.json', seed=0):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{')
+        for number, (id, teacher) in enumerate(generate_teachers(count, source, goals, seed)):
+            if number:
+                f.write(',')
+            f.write('\n{}: {}'.format(json.dumps(id), json.dumps(teacher, ensure_ascii=False)))
+        f.write('\n}\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic teachers.json with the given number of teachers.')
+    parser.add_argument('count', type=int)
+    parser.add_argument('--out', default='teachers_generated.json')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_teachers(args.out, args.count, seed=args.seed)
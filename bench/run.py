@@ -0,0 +1,216 @@
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.generate import write_teachers
+
+# Load test for the app's routes on synthetic catalogs.
+# For every catalog size the app is seeded into a scratch SQLite database and driven twice:
+# through the Flask test client (one request at a time, exact query count per request) and through
+# an in-process WSGI server at the given concurrency levels. Results are written as JSON and can be
+# compared with a stored baseline, which makes the command fail on regressions.
+#
+#   python -m bench.run --sizes 1000 10000 100000 --concurrency 1 8 32
+#   python -m bench.run --save-baseline              # after a deliberate change in performance
+#   python -m bench.run --baseline bench/baseline.json
+
+BOOKING_DAYS = ['mon', 'tue', 'wed', 'thu', 'fri']
+BOOKING_TIMES = ['8', '10', '12', '14', '16']
+GOALS = ['travel', 'study', 'work', 'relocate']
+SEARCH_WORDS = ['английский', 'travel', 'учеба', 'native', 'разговорный']
+
+query_count = 0
+query_count_lock = threading.Lock()
+
+
+def count_query(*args):
+    global query_count
+    with query_count_lock:
+        query_count += 1
+
+
+def make_request(route, size, rng):
+    # (method, path, form data) of a random request to route.
+    id = rng.randint(1, size)
+    if route == 'main':
+        # With a slot asked for: the slots left today depend on the clock, and so would the work the page does.
+        return 'GET', '/?' + urllib.parse.urlencode({'day': rng.choice(BOOKING_DAYS),
+                                                     'time': rng.choice(BOOKING_TIMES)}), None
+    if route == 'goals':
+        return 'GET', '/goals/{}/'.format(rng.choice(GOALS)), None
+    if route == 'profiles':
+        return 'GET', '/profiles/{}/'.format(id), None
+    if route == 'booking':
+        return 'GET', '/booking/{}/{}/{}'.format(id, rng.choice(BOOKING_DAYS), rng.choice(BOOKING_TIMES)), None
+    if route == 'sent':
+        return 'POST', '/sent/', {'teacher_id': str(id),
+                                  'day': rng.choice(BOOKING_DAYS),
+                                  'time': rng.choice(BOOKING_TIMES),
+                                  'name': 'Bench',
+                                  'phone': '+7{:010d}'.format(rng.randrange(10 ** 10))}
+    if route == 'search':
+        return 'GET', '/search?' + urllib.parse.urlencode({'s': rng.choice(SEARCH_WORDS)}), None
+    raise ValueError(route)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+def summary(latencies, elapsed, queries):
+    return {'requests': len(latencies),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'throughput_rps': round(len(latencies) / elapsed, 1),
+            'queries_per_request': round(queries / len(latencies), 2)}
+
+
+def run_test_client(app, route, size, requests, rng):
+    client = app.test_client()
+    latencies = []
+    queries_before = query_count
+    started = time.perf_counter()
+    for _ in range(requests):
+        method, path, data = make_request(route, size, rng)
+        request_started = time.perf_counter()
+        response = client.open(path, method=method, data=data)
+        # Streamed pages are rendered while the body is read.
+        response.get_data()
+        latencies.append(time.perf_counter() - request_started)
+        if response.status_code >= 500:
+            raise RuntimeError('{} {} returned {}'.format(method, path, response.status_code))
+    return summary(latencies, time.perf_counter() - started, query_count - queries_before)
+
+
+def run_server(base_url, route, size, requests, concurrency, rng):
+    planned = [make_request(route, size, rng) for _ in range(requests)]
+
+    def send(planned_request):
+        method, path, data = planned_request
+        body = urllib.parse.urlencode(data).encode() if data else None
+        request_started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(urllib.request.Request(base_url + path, data=body, method=method)) as response:
+                response.read()
+        except urllib.error.HTTPError as error:
+            if error.code >= 500:
+                raise
+        return time.perf_counter() - request_started
+
+    queries_before = query_count
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = list(pool.map(send, planned))
+    return summary(latencies, time.perf_counter() - started, query_count - queries_before)
+
+
+def compare(results, baseline, tolerance):
+    # Regressions: p95 slower than the baseline by more than tolerance, or more queries per request.
+    stored = {(r['size'], r['mode'], r['concurrency'], r['route']): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        base = stored.get((result['size'], result['mode'], result['concurrency'], result['route']))
+        if base is None:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append('{route} ({size} teachers, {mode}, x{concurrency}): p95 {p95_ms} ms'.format(**result)
+                               + ', baseline {} ms'.format(base['p95_ms']))
+        if result['queries_per_request'] > base['queries_per_request']:
+            regressions.append('{route} ({size} teachers, {mode}, x{concurrency}): '.format(**result)
+                               + '{} queries per request, baseline {}'.format(result['queries_per_request'],
+                                                                               base['queries_per_request']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the app routes on synthetic catalogs.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--routes', nargs='+', default=['main', 'goals', 'profiles', 'booking', 'sent', 'search'])
+    parser.add_argument('--requests', type=int, default=200, help='requests per route and concurrency level')
+    parser.add_argument('--cache', action='store_true', help='keep the page cache on (off by default)')
+    parser.add_argument('--out', default='bench/results.json')
+    parser.add_argument('--baseline', help='compare with this file and exit with 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--save-baseline', action='store_true', help='also write the results to bench/baseline.json')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='tinysteps-bench-')
+    # The app reads these when it is imported.
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    os.environ['PAGE_CACHE'] = 'local' if args.cache else 'off'
+    import app as tinysteps
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from werkzeug.serving import make_server
+
+    app = tinysteps.create_app({'WTF_CSRF_ENABLED': False, 'INTAKE_STORE': 'off'})
+    # Query counts are compared exactly, so every run has to make the same queries: the catalog snapshot, matcher and
+    # slot index are built once per catalog size, on first use, and never rebuilt on a timer or after a booking.
+    tinysteps.CATALOG_CHECK_INTERVAL = tinysteps.MATCHER_TTL = tinysteps.SLOT_INDEX_TTL = float('inf')
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    event.listen(Engine, 'before_cursor_execute', count_query)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+
+    results = []
+    try:
+        for size in args.sizes:
+            teachers_path = os.path.join(workdir, 'teachers.json')
+            write_teachers(teachers_path, size)
+            with app.app_context():
+                tinysteps.db.drop_all()
+                tinysteps.create_schema()
+                tinysteps.seed_catalog('goals.json', teachers_path)
+                tinysteps.db.session.remove()
+            tinysteps.matcher = None
+            tinysteps.slot_index = None
+            tinysteps.catalog_snapshot = None
+            tinysteps.search_index.fallback = None
+
+            for route in args.routes:
+                rng = random.Random(size)
+                result = run_test_client(app, route, size, args.requests, rng)
+                results.append(dict(result, size=size, mode='test_client', concurrency=1, route=route))
+                for concurrency in args.concurrency:
+                    result = run_server(base_url, route, size, args.requests, concurrency, rng)
+                    results.append(dict(result, size=size, mode='wsgi', concurrency=concurrency, route=route))
+                for result in results[-1 - len(args.concurrency):]:
+                    print('{size:>7} {route:<9} {mode:<11} x{concurrency:<3} p50 {p50_ms:>8} ms  p95 {p95_ms:>8} ms  '
+                          'p99 {p99_ms:>8} ms  {throughput_rps:>8} rps  {queries_per_request:>6} q/req'.format(**result))
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0], 'results': results}
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open('bench/baseline.json', 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
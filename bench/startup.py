@@ -0,0 +1,117 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from bench.generate import write_teachers
+
+# Startup budget: how long a fresh process takes to import the app and run create_app(), and how long the first
+# requests take, on catalogs of several sizes. Every measurement runs in a new Python process, like a new worker.
+# "preload" does what gunicorn --preload does (import, create_app() and warm_up() once, then fork) and times the
+# first requests of the forked worker.
+#
+#   python -m bench.startup --sizes 1000 100000 --budget-ms 1000
+
+ROUTES = ['/', '/goals/travel/', '/profiles/1/', '/search?s=english', '/api/v1/teachers']
+
+MEASURE = '''
+import json, os, sys, time
+started = time.perf_counter()
+import app as tinysteps
+imported = time.perf_counter()
+app = tinysteps.create_app()
+created = time.perf_counter()
+result = {'import_ms': (imported - started) * 1000, 'create_app_ms': (created - imported) * 1000}
+
+
+def first_requests():
+    client = app.test_client()
+    timings = {}
+    for route in ROUTES:
+        request_started = time.perf_counter()
+        response = client.get(route)
+        # Streamed pages are rendered while the body is read; closing the response ends their request context.
+        response.get_data()
+        response.close()
+        timings[route] = (time.perf_counter() - request_started) * 1000
+        if response.status_code >= 500:
+            raise RuntimeError('{} returned {}'.format(route, response.status_code))
+    return timings
+
+
+if MODE == 'cold':
+    result['first_request_ms'] = first_requests()
+else:
+    tinysteps.warm_up(app)
+    result['warm_up_ms'] = (time.perf_counter() - created) * 1000
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        os.write(write, json.dumps(first_requests()).encode())
+        os._exit(0)
+    os.close(write)
+    with os.fdopen(read) as pipe:
+        result['first_request_ms'] = json.loads(pipe.read())
+    os.waitpid(pid, 0)
+print(json.dumps(result))
+'''
+
+
+def measure(mode, database_url):
+    env = dict(os.environ, DATABASE_URL=database_url, PAGE_CACHE='off')
+    code = 'ROUTES = {!r}\nMODE = {!r}\n'.format(ROUTES, mode) + MEASURE
+    output = subprocess.run([sys.executable, '-c', code], env=env, check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure app startup and first requests in fresh processes.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000])
+    parser.add_argument('--budget-ms', type=float, default=1000,
+                        help='limit for import + create_app() and for any first request of a preloaded worker')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='tinysteps-startup-')
+    over_budget = []
+    try:
+        for size in args.sizes:
+            database_url = 'sqlite:///' + os.path.join(workdir, 'startup-{}.db'.format(size))
+            teachers_path = os.path.join(workdir, 'teachers.json')
+            write_teachers(teachers_path, size)
+            env = dict(os.environ, DATABASE_URL=database_url, FLASK_APP='app')
+            subprocess.run([sys.executable, '-m', 'flask', 'seed', '--teachers', teachers_path], env=env, check=True,
+                           stdout=subprocess.DEVNULL)
+
+            for mode in ('cold', 'preload'):
+                result = measure(mode, database_url)
+                startup = result['import_ms'] + result['create_app_ms']
+                line = '{:>7} {:<8} import {:6.0f} ms  create_app {:5.0f} ms'.format(
+                    size, mode, result['import_ms'], result['create_app_ms'])
+                if 'warm_up_ms' in result:
+                    line += '  warm-up {:6.0f} ms'.format(result['warm_up_ms'])
+                print(line)
+                for route, elapsed in result['first_request_ms'].items():
+                    print('          first {:<20} {:8.1f} ms'.format(route, elapsed))
+                if startup > args.budget_ms:
+                    over_budget.append('{} teachers, {}: import + create_app {:.0f} ms'.format(size, mode, startup))
+                if mode == 'preload':
+                    for route, elapsed in result['first_request_ms'].items():
+                        if elapsed > args.budget_ms:
+                            over_budget.append('{} teachers, preloaded worker: first {} {:.0f} ms'.format(
+                                size, route, elapsed))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for line in over_budget:
+        print('OVER BUDGET: ' + line)
+    if over_budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Rendered pages are cached in a backend: LocalBackend is an LRU inside the process,
+# SQLiteBackend is a file every gunicorn worker on the host shares (a stand-in for memcached/redis,
+# anything with get/set/delete/incr can replace it).
+# Pages are invalidated by tags ("teacher:5", "goal:2"): every tag has a version number, kept in the backend itself
+# (BackendTags) or in any store with versions() and bump() shared more widely than the pages, like a database table.
+# A page remembers the versions of its tags when it was rendered and is stale once any of them is bumped.
+
+
+class LRUCache:
+    # Size-bounded, thread-safe LRU with a time to live per entry.
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        with self.lock:
+            self.entries[key] = (value, time.time() + ttl if ttl else None)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class LocalBackend(LRUCache):
+    # Counters (tag versions) live outside the LRU: an evicted version would restart from 0
+    # and could make an old page look fresh again.
+    def __init__(self, max_size=1000, ttl=None):
+        super().__init__(max_size, ttl)
+        self.counters = {}
+
+    def get(self, key):
+        if key in self.counters:
+            return self.counters[key]
+        return super().get(key)
+
+    def incr(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            return self.counters[key]
+
+
+class SQLiteBackend:
+    # Every sweep_every sets the process deletes expired entries and, beyond max_size, those expiring soonest.
+    # Entries without a time to live (counters) are never swept.
+    def __init__(self, path, ttl=None, max_size=None, sweep_every=100):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.sweep_every = sweep_every
+        self.sets = 0
+        self.local = threading.local()
+        # A forked worker must not use the connections of the process it was forked from.
+        os.register_at_fork(after_in_child=self.after_fork)
+        self.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+        self.execute('CREATE INDEX IF NOT EXISTS ix_cache_expires ON cache (expires)')
+
+    def after_fork(self):
+        self.local = threading.local()
+
+    def connection(self):
+        # One connection per thread; sqlite3 connections must not be shared between threads.
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self.local.connection.execute('PRAGMA journal_mode=WAL')
+        return self.local.connection
+
+    def execute(self, sql, parameters=()):
+        return self.connection().execute(sql, parameters)
+
+    def get(self, key):
+        row = self.execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] is not None and row[1] < time.time():
+            self.delete(key)
+            return None
+        return pickle.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        self.execute('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                     (key, pickle.dumps(value), time.time() + ttl if ttl else None))
+        self.sets += 1
+        if self.sets % self.sweep_every == 0:
+            self.sweep()
+
+    def sweep(self):
+        self.execute('DELETE FROM cache WHERE expires < ?', (time.time(),))
+        if self.max_size is not None:
+            self.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache WHERE expires IS NOT NULL '
+                         'ORDER BY expires DESC LIMIT -1 OFFSET ?)', (self.max_size,))
+
+    def delete(self, key):
+        self.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def incr(self, key):
+        # Versions are pickled ints like everything else; BEGIN IMMEDIATE makes read-and-write atomic across processes.
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+            value = (pickle.loads(row[0]) if row else 0) + 1
+            connection.execute('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, NULL)',
+                               (key, pickle.dumps(value)))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return value
+
+    def clear(self):
+        self.execute('DELETE FROM cache')
+
+
+class BackendTags:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def versions(self, tags):
+        return tuple(self.backend.get('tag:' + tag) or 0 for tag in tags)
+
+    def bump(self, tags):
+        for tag in tags:
+            self.backend.incr('tag:' + tag)
+
+
+class CachedPage:
+    __slots__ = ('body', 'etag', 'last_modified', 'tags', 'versions', 'variants')
+
+    def __init__(self, body, etag, last_modified, tags, versions, variants):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.tags = tags
+        self.versions = versions
+        # Content-Encoding -> the body encoded so, made once when the page is cached.
+        self.variants = variants
+
+
+class PageCache:
+    def __init__(self, backend, ttl=None, tags=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.tags = tags or BackendTags(backend)
+
+    def versions(self, tags):
+        return self.tags.versions(tags)
+
+    def get(self, key):
+        page = self.backend.get('page:' + key)
+        # Pages pickled (SQLiteBackend) before they had variants are rendered again.
+        if page is None or not hasattr(page, 'variants') or self.versions(page.tags) != page.versions:
+            return None
+        return page
+
+    def set(self, key, body, versions, ttl=None, variants=None):
+        # versions maps tag -> version; read them before the data they stand for, so an invalidation
+        # that happens while the page is rendered is not lost.
+        tags = tuple(sorted(versions))
+        page = CachedPage(body,
+                          hashlib.md5(body.encode('utf-8')).hexdigest(),
+                          int(time.time()),
+                          tags,
+                          tuple(versions[tag] for tag in tags),
+                          variants or {})
+        self.backend.set('page:' + key, page, ttl or self.ttl)
+        return page
+
+    def invalidate(self, *tags):
+        if tags:
+            self.tags.bump(tags)
@@ -0,0 +1,116 @@
+import numpy as np
+
+# Read-only snapshot of the catalog for the pages: goals, and teachers with their texts, prices, ratings, review counts
+# and goals. Schedules are not in it: they change with every booking and are read from the database.
+# Teachers are kept column by column, numbers in numpy arrays and every text column in one UTF-8 blob with offsets,
+# so a snapshot is a few dozen Python objects whatever the number of teachers. Built in the gunicorn master before the
+# fork, it stays shared between the workers: reading it does not write reference counts all over its memory.
+# Records are made on access. Every goal has its teachers in page order for every sort, so a page of a goal is a binary
+# search for the cursor and a slice.
+
+
+class TeacherRecord:
+    __slots__ = ('id', 'name', 'about', 'rating', 'price', 'version', 'review_count', 'goal_mask')
+
+    def __init__(self, id, name, about, rating, price, version, review_count, goal_mask):
+        self.id = id
+        self.name = name
+        self.about = about
+        self.rating = rating
+        self.price = price
+        self.version = version
+        self.review_count = review_count
+        self.goal_mask = goal_mask
+
+
+class GoalRecord:
+    __slots__ = ('id', 'name_en', 'name_ru', 'teacher_count', 'price_sum', 'review_count', 'rating_sum', 'walks')
+
+    def __init__(self, id, name_en, name_ru, teacher_count, price_sum, review_count, rating_sum):
+        self.id = id
+        self.name_en = name_en
+        self.name_ru = name_ru
+        self.teacher_count = teacher_count
+        self.price_sum = price_sum
+        self.review_count = review_count
+        self.rating_sum = rating_sum
+        # sort -> (sign, rows in page order, sign * sort value and sign * id of every row), see Catalog.goal_rows().
+        self.walks = {}
+
+
+class TextColumn:
+    __slots__ = ('blob', 'offsets')
+
+    def __init__(self, texts):
+        encoded = [text.encode() for text in texts]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(text) for text in encoded], out=self.offsets[1:])
+        self.blob = b''.join(encoded)
+
+    def __getitem__(self, row):
+        return self.blob[self.offsets[row]:self.offsets[row + 1]].decode()
+
+
+class Catalog:
+    def __init__(self, version, teachers, goals, sorts):
+        # teachers: (id, name, about, rating, price, version, review_count, goal_mask) ordered by id;
+        # goals: (id, name_en, name_ru, teacher_count, price_sum, review_count, rating_sum) ordered by id;
+        # sorts: {'rating': 'desc', 'price': 'asc'}, the orders of goal pages.
+        self.version = version
+        columns = list(zip(*teachers)) or [()] * 8
+        self.ids = np.array(columns[0], dtype=np.int64)
+        self.names = TextColumn(columns[1])
+        self.abouts = TextColumn(columns[2])
+        self.ratings = np.array(columns[3], dtype=np.float64)
+        self.prices = np.array(columns[4], dtype=np.float64)
+        self.versions = np.array(columns[5], dtype=np.int64)
+        self.review_counts = np.array(columns[6], dtype=np.int64)
+        self.goal_masks = np.array(columns[7], dtype=np.int64)
+
+        values = {'rating': self.ratings, 'price': self.prices}
+        self.goals = {}
+        self.goals_by_name = {}
+        for row in goals:
+            goal = GoalRecord(*row)
+            rows = np.flatnonzero((self.goal_masks >> goal.id) & 1)
+            for sort, direction in sorts.items():
+                sign = -1 if direction == 'desc' else 1
+                first = sign * values[sort][rows]
+                second = sign * self.ids[rows]
+                order = np.lexsort((second, first))
+                goal.walks[sort] = (sign, rows[order], first[order], second[order])
+            self.goals[goal.id] = goal
+            self.goals_by_name[goal.name_en] = goal
+
+    def row(self, teacher_id):
+        position = int(np.searchsorted(self.ids, teacher_id))
+        if position < len(self.ids) and self.ids[position] == teacher_id:
+            return position
+        return None
+
+    def record(self, row):
+        return TeacherRecord(int(self.ids[row]), self.names[row], self.abouts[row], float(self.ratings[row]),
+                             float(self.prices[row]), int(self.versions[row]), int(self.review_counts[row]),
+                             int(self.goal_masks[row]))
+
+    def teacher(self, teacher_id):
+        # None for a teacher the snapshot does not know (yet).
+        row = self.row(teacher_id)
+        return None if row is None else self.record(row)
+
+    def goal_names(self, teacher):
+        return tuple(goal.name_ru for goal in self.goals.values() if teacher.goal_mask >> goal.id & 1)
+
+    def goal_rows(self, goal, sort, after=None):
+        # Rows of the goal's teachers in page order, starting after the (sort value, id) cursor.
+        sign, rows, first, second = goal.walks[sort]
+        if after is None:
+            return rows
+        value, id = sign * after[0], sign * after[1]
+        low = int(np.searchsorted(first, value, 'left'))
+        high = int(np.searchsorted(first, value, 'right'))
+        return rows[low + int(np.searchsorted(second[low:high], id, 'right')):]
+
+    def rows_of(self, rows, teacher_ids):
+        # The rows whose teachers are in teacher_ids, order kept.
+        return rows[np.isin(self.ids[rows], teacher_ids)]
@@ -0,0 +1,64 @@
+import gzip
+import zlib
+
+# Response compression: gzip, and brotli when the brotli package is installed (requirements.txt has it; without it,
+# say in a bare development environment, everything is gzipped). Cached pages are compressed once, at a high level, and their compressed variants are kept with them;
+# everything else is compressed as it is sent at a faster level. A streamed response is compressed as one stream,
+# flushed after every chunk, so the browser can render each chunk as soon as the app has produced it.
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# In order of preference.
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+# Images and fonts are compressed already.
+COMPRESSIBLE = {'text/html', 'text/plain', 'text/css', 'text/javascript', 'application/javascript', 'application/json',
+                'application/x-ndjson', 'image/svg+xml'}
+FAST = {'br': 4, 'gzip': 6}
+# Brotli's top level 11 costs tens of milliseconds a page for a few percent less; 9 is a few milliseconds.
+BEST = {'br': 9, 'gzip': 9}
+
+
+def negotiate(accept_encodings, available=ENCODINGS):
+    # The preferred encoding of available the client takes (werkzeug's request.accept_encodings), or None.
+    for encoding in ENCODINGS:
+        if encoding in available and accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def compress(data, encoding, levels=FAST):
+    if encoding == 'br':
+        return brotli.compress(data, quality=levels['br'])
+    # mtime=0 keeps the output the same for the same data.
+    return gzip.compress(data, levels['gzip'], mtime=0)
+
+
+def encoded(chunks):
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        if chunk:
+            yield chunk
+
+
+def compress_chunks(chunks, encoding, levels=FAST):
+    # Compresses an iterable of str or bytes chunks as one stream, yielding what every chunk has made.
+    try:
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=levels['br'])
+            for chunk in encoded(chunks):
+                yield compressor.process(chunk) + compressor.flush()
+            yield compressor.finish()
+        else:
+            # wbits 31: a gzip header and trailer around the deflate stream.
+            compressor = zlib.compressobj(levels['gzip'], zlib.DEFLATED, 31)
+            for chunk in encoded(chunks):
+                yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield compressor.flush()
+    finally:
+        # The wrapped stream is closed too when the client goes away in the middle of it.
+        if hasattr(chunks, 'close'):
+            chunks.close()
@@ -0,0 +1,108 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Throttling of the lead forms (booking, message, request).
+# Every client IP and every phone number has a token bucket: `burst` submissions right away, then one more every
+# 60 / per_minute seconds. A submission over the limit is answered 429 before the form is validated, so floods cost
+# neither a database query nor a template render.
+# Buckets live in a store: MemoryStore is per worker, SQLiteStore is one file shared by all workers on the host
+# (a stand-in for redis; anything with take(key, burst, rate, now) can replace it).
+
+
+def normalize_phone(phone):
+    # '+7 (912) 345-67-89', '8 912 345 67 89' and '9123456789' are all '+79123456789'; None for something else.
+    if phone is None:
+        return None
+    digits = re.sub(r'\D', '', phone)
+    if len(digits) == 10:
+        digits = '7' + digits
+    elif len(digits) == 11 and digits.startswith('8'):
+        digits = '7' + digits[1:]
+    if not 11 <= len(digits) <= 15:
+        return None
+    return '+' + digits
+
+
+def refill(tokens, updated, burst, rate, now):
+    # Tokens of a bucket last seen at `updated`, at `rate` tokens a second; a bucket never holds more than burst.
+    return min(burst, tokens + (now - updated) * rate)
+
+
+class MemoryStore:
+    # Buckets in an LRU: a bucket dropped for room is simply full again next time.
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, burst, rate, now):
+        # Takes a token; returns the tokens left, negative when there was none to take.
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (burst, now))
+            tokens = refill(tokens, updated, burst, rate, now)
+            left = tokens - 1
+            self.buckets[key] = (left if left >= 0 else tokens, now)
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > self.max_size:
+                self.buckets.popitem(last=False)
+            return left
+
+
+class SQLiteStore:
+    # Buckets untouched for this long are full again whatever their rate, and are deleted now and then.
+    IDLE = 24 * 3600
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.takes = 0
+        os.register_at_fork(after_in_child=self.after_fork)
+        self.connection().execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+
+    def after_fork(self):
+        self.local = threading.local()
+
+    def connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self.local.connection.execute('PRAGMA journal_mode=WAL')
+            self.local.connection.execute('PRAGMA synchronous=OFF')
+        return self.local.connection
+
+    def take(self, key, burst, rate, now):
+        # BEGIN IMMEDIATE makes read-and-write atomic across processes.
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens = refill(row[0], row[1], burst, rate, now) if row else burst
+            left = tokens - 1
+            connection.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                               (key, left if left >= 0 else tokens, now))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        self.takes += 1
+        if self.takes % self.PRUNE_EVERY == 0:
+            connection.execute('DELETE FROM buckets WHERE updated < ?', (now - self.IDLE,))
+        return left
+
+
+class RateLimiter:
+    def __init__(self, store, burst, per_minute):
+        self.store = store
+        self.burst = burst
+        self.rate = per_minute / 60.0
+
+    def hit(self, key):
+        # None when the submission may go on, otherwise seconds until the bucket has a token again.
+        left = self.store.take(key, self.burst, self.rate, time.time())
+        if left >= 0:
+            return None
+        return -left / self.rate
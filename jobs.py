@@ -0,0 +1,133 @@
+import json
+import logging
+import threading
+import time
+import uuid
+
+from sqlalchemy import and_, or_, select
+
+# Background jobs kept in an outbox table (the Job model in app.py).
+# enqueue() only adds a row to the current session, so the job is committed in the same
+# transaction as the booking or message it belongs to, and the request returns right away.
+# Workers ("flask worker") claim pending jobs in batches with one UPDATE, hand each batch to a
+# transport and retry failed deliveries with exponential backoff until MAX_ATTEMPTS.
+
+logger = logging.getLogger('tinysteps.jobs')
+
+BATCH_SIZE = 20
+MAX_ATTEMPTS = 5
+# Seconds before the first retry; doubled for every further attempt.
+BACKOFF = 30
+# A job still 'running' after this many seconds belongs to a worker that died; it is claimed again.
+LOCK_TIMEOUT = 300
+
+
+class StubTransport:
+    # Stands in for SMS/email delivery: writes notifications to the log.
+    def __init__(self):
+        self.sent = []
+
+    def send_batch(self, jobs):
+        # Returns {job id: error message or None}.
+        results = {}
+        for job in jobs:
+            logger.info('Notification %s #%s: %s', job['kind'], job['id'], json.dumps(job['payload'], ensure_ascii=False))
+            self.sent.append(job)
+            results[job['id']] = None
+        return results
+
+
+class JobQueue:
+    def __init__(self, db, model, transport=None):
+        self.db = db
+        self.model = model
+        self.table = model.__table__
+        self.transport = transport or StubTransport()
+
+    def enqueue(self, kind, payload):
+        # Committed (or rolled back) together with the caller's transaction.
+        now = time.time()
+        self.db.session.add(self.model(kind=kind, payload=json.dumps(payload), status='pending',
+                                       attempts=0, run_at=now, created_at=now))
+
+    def claim(self, batch_size=BATCH_SIZE):
+        # Marks up to batch_size due jobs as running with a token of our own in a single UPDATE,
+        # so two workers never get the same job, then reads them back by that token.
+        # The UPDATE checks that a job is due again: on PostgreSQL a worker that waited for another one's row locks
+        # re-evaluates only the outer WHERE on the rows it then gets, and must skip those just claimed. SKIP LOCKED
+        # lets it take other due jobs instead of waiting (SQLite has one writer at a time and leaves FOR UPDATE out).
+        token = uuid.uuid4().hex
+        now = time.time()
+        table = self.table
+        is_due = or_(and_(table.c.status == 'pending', table.c.run_at <= now),
+                     and_(table.c.status == 'running', table.c.locked_at < now - LOCK_TIMEOUT))
+        due = select([table.c.id])\
+            .where(is_due)\
+            .order_by(table.c.run_at)\
+            .limit(batch_size)\
+            .with_for_update(skip_locked=True)
+        with self.db.engine.begin() as connection:
+            connection.execute(table.update()
+                               .where(and_(table.c.id.in_(due), is_due))
+                               .values(status='running', claim_token=token, locked_at=now))
+            rows = connection.execute(select([table.c.id, table.c.kind, table.c.payload, table.c.attempts])
+                                      .where(table.c.claim_token == token)).fetchall()
+        return [{'id': row.id, 'kind': row.kind, 'payload': json.loads(row.payload), 'attempts': row.attempts}
+                for row in rows]
+
+    def process(self, jobs):
+        try:
+            results = self.transport.send_batch(jobs)
+        except Exception as error:
+            logger.exception('Transport failed for a batch of %d jobs', len(jobs))
+            results = {job['id']: str(error) for job in jobs}
+
+        now = time.time()
+        table = self.table
+        with self.db.engine.begin() as connection:
+            for job in jobs:
+                error = results.get(job['id'], 'no result from transport')
+                attempts = job['attempts'] + 1
+                if error is None:
+                    values = {'status': 'done', 'attempts': attempts, 'last_error': None}
+                elif attempts >= MAX_ATTEMPTS:
+                    logger.error('Job %s (%s) failed for good: %s', job['id'], job['kind'], error)
+                    values = {'status': 'failed', 'attempts': attempts, 'last_error': error}
+                else:
+                    values = {'status': 'pending', 'attempts': attempts, 'last_error': error,
+                              'run_at': now + BACKOFF * 2 ** (attempts - 1)}
+                connection.execute(table.update().where(table.c.id == job['id']).values(claim_token=None, **values))
+
+    def run_once(self, batch_size=BATCH_SIZE):
+        jobs = self.claim(batch_size)
+        if jobs:
+            self.process(jobs)
+        return len(jobs)
+
+    def run_workers(self, app, threads=2, poll_interval=1.0, stop=None):
+        # Blocks until stop (a threading.Event) is set; every thread claims and delivers batches on its own.
+        stop = stop or threading.Event()
+
+        def work():
+            with app.app_context():
+                while not stop.is_set():
+                    try:
+                        processed = self.run_once()
+                    except Exception:
+                        logger.exception('Job worker error')
+                        processed = 0
+                    if not processed:
+                        stop.wait(poll_interval)
+
+        workers = [threading.Thread(target=work, name='job-worker-{}'.format(number), daemon=True)
+                   for number in range(threads)]
+        for worker in workers:
+            worker.start()
+        try:
+            while any(worker.is_alive() for worker in workers):
+                for worker in workers:
+                    worker.join(0.5)
+        except KeyboardInterrupt:
+            stop.set()
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,75 @@
+import json
+
+# Reading teachers.json with json.load() keeps the whole catalog in memory at once.
+# iter_object_items() reads a file holding one big JSON object in chunks and yields its
+# (key, value) pairs one by one, so only a single value is held in memory at a time.
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = ' \t\n\r'
+
+decoder = json.JSONDecoder()
+
+
+class _Reader:
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def more(self):
+        # Drops what was already parsed and appends the next chunk. False at the end of the file.
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        if not chunk:
+            self.eof = True
+        return bool(chunk)
+
+    def peek(self):
+        # Next non-whitespace character, without consuming it.
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.more():
+                raise ValueError('Unexpected end of JSON input')
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected {!r} at position {} of the chunk'.format(char, self.pos))
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if self.more():
+                    continue
+                raise
+            # A number at the very end of the buffer may continue in the next chunk.
+            if end == len(self.buffer) and self.more():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_object_items(path, chunk_size=CHUNK_SIZE):
+    with open(path, encoding='utf-8') as f:
+        reader = _Reader(f, chunk_size)
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            key = reader.value()
+            reader.expect(':')
+            yield key, reader.value()
+            if reader.peek() == '}':
+                return
+            reader.expect(',')
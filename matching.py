@@ -0,0 +1,94 @@
+import numpy as np
+
+import availability
+
+# Tutor matching for the /request form.
+# Every teacher is one row of precomputed features (goal bits, free slot counts per part of the day,
+# rating, price), so a request is scored with a few numpy operations over the whole catalog
+# instead of a Python loop over ORM objects.
+
+# Parts of the day a student can prefer, as free_mask bits.
+DAYPARTS = {'morning': ['8:00', '10:00'],
+            'day': ['12:00', '14:00', '16:00'],
+            'evening': ['18:00', '20:00', '22:00']}
+DAYPART_MASKS = {}
+for daypart, daypart_times in DAYPARTS.items():
+    DAYPART_MASKS[daypart] = 0
+    for daypart_time in daypart_times:
+        DAYPART_MASKS[daypart] |= availability.time_mask(daypart_time)
+
+# Weight of each part of the score; all parts are scaled to 0..1 first.
+RATING_WEIGHT = 0.5
+PRICE_WEIGHT = 0.3
+SLOTS_WEIGHT = 0.2
+
+
+class Matcher:
+    def __init__(self, teachers, bookable_mask):
+        # teachers: iterable of (id, rating, price, free_mask, goal_mask), goal_mask having bit 1 << goal id set
+        # for every goal of the teacher. Only free slots in bookable_mask are counted.
+        teachers = list(teachers)
+        self.ids = np.array([teacher[0] for teacher in teachers], dtype=np.int64)
+        self.bookable_mask = bookable_mask
+        self.rating = np.array([teacher[1] for teacher in teachers], dtype=np.float64)
+        self.price = np.array([teacher[2] for teacher in teachers], dtype=np.float64)
+        self.goals = np.array([teacher[4] for teacher in teachers], dtype=np.int64)
+        # Free slots in total and per part of the day, counted once here rather than per request.
+        free_masks = [(teacher[3] or 0) & bookable_mask for teacher in teachers]
+        self.slots = {None: np.array([availability.count_slots(mask) for mask in free_masks], dtype=np.int64)}
+        for daypart, daypart_mask in DAYPART_MASKS.items():
+            self.slots[daypart] = np.array([availability.count_slots(mask & daypart_mask) for mask in free_masks],
+                                           dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def take(self, teacher_id, day, time):
+        # A booked slot is one free slot less, in total and in its part of the day; applied in place, so the matcher
+        # needs no rebuild. Needs the teachers in id order.
+        index = np.searchsorted(self.ids, teacher_id)
+        if index == len(self.ids) or self.ids[index] != teacher_id:
+            return
+        bit = availability.slot_bit(day, time)
+        if not bit & self.bookable_mask:
+            return
+        self.slots[None][index] -= 1
+        for daypart, daypart_mask in DAYPART_MASKS.items():
+            if bit & daypart_mask:
+                self.slots[daypart][index] -= 1
+
+    def match(self, goal_id, min_slots, max_price=None, daypart=None, limit=10):
+        # Ranked ids of teachers that teach the goal and have at least min_slots free slots
+        # (in the preferred part of the day, if any) at no more than max_price.
+        if not len(self.ids):
+            return []
+        slots = self.slots[daypart]
+        suitable = ((self.goals & (1 << goal_id)) != 0) & (slots >= min_slots)
+        if max_price is not None:
+            suitable &= self.price <= max_price
+        candidates = np.flatnonzero(suitable)
+        if not len(candidates):
+            return []
+
+        rating = self.rating[candidates]
+        price = self.price[candidates]
+        score = RATING_WEIGHT * scale(rating) \
+            + PRICE_WEIGHT * (1 - scale(price)) \
+            + SLOTS_WEIGHT * np.minimum(slots[candidates] / max(min_slots, 1) / 2, 1)
+
+        if len(candidates) > limit:
+            best = np.argpartition(-score, limit)[:limit]
+        else:
+            best = np.arange(len(candidates))
+        # Highest score first, lower id on ties.
+        best = best[np.lexsort((self.ids[candidates][best], -score[best]))]
+        return self.ids[candidates][best].tolist()
+
+
+def scale(values):
+    # Min-max scaling to 0..1; all equal values give 0.5.
+    low = values.min()
+    high = values.max()
+    if high == low:
+        return np.full(len(values), 0.5)
+    return (values - low) / (high - low)
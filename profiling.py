@@ -0,0 +1,269 @@
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request, signals
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Opt-in per-request instrumentation (PROFILING=1).
+# For every request it records the number of SQL statements, total SQL time, the slowest statements
+# and Jinja render time, and sends them back as a Server-Timing header (browser dev tools show it).
+# Totals per endpoint are exposed at /metrics in Prometheus text format (per worker process).
+# Requests slower than PROFILING_SLOW_MS are logged together with the slowest statements and the
+# stacks a background thread sampled while the request ran; the same statement repeated
+# PROFILING_REPEAT_THRESHOLD or more times in one request is logged as a possible N+1.
+
+logger = logging.getLogger('tinysteps.profiling')
+
+# Request duration histogram buckets, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SLOWEST_STATEMENTS = 5
+SAMPLED_FRAMES = 8
+STDLIB = os.path.dirname(os.__file__)
+
+
+class RequestProfile:
+    __slots__ = ('started', 'queries', 'sql_time', 'slowest', 'statements', 'render_time', 'render_started',
+                 'samples')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.slowest = []
+        self.statements = Counter()
+        self.render_time = 0.0
+        self.render_started = []
+        self.samples = Counter()
+
+
+class EndpointStats:
+    __slots__ = ('requests', 'duration', 'buckets', 'queries', 'sql_time', 'render_time', 'slow', 'n_plus_one')
+
+    def __init__(self):
+        self.requests = 0
+        self.duration = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self.queries = 0
+        self.sql_time = 0.0
+        self.render_time = 0.0
+        self.slow = 0
+        self.n_plus_one = 0
+
+
+class Profiler:
+    def __init__(self, app=None):
+        self.stats = {}
+        self.lock = threading.Lock()
+        # thread id -> RequestProfile of the request that thread is running.
+        self.active = {}
+        self.sampler_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILING_SLOW_MS', 500)
+        app.config.setdefault('PROFILING_SAMPLE_INTERVAL', 0.01)
+        app.config.setdefault('PROFILING_REPEAT_THRESHOLD', 5)
+        self.app = app
+
+        event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+        if getattr(signals, 'signals_available', True):
+            signals.before_render_template.connect(self.before_render, app)
+            signals.template_rendered.connect(self.after_render, app)
+        else:
+            logger.warning('blinker is not installed, template render time is not measured')
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.teardown_request(self.teardown_request)
+        app.add_url_rule('/metrics', 'metrics', self.metrics)
+
+    def profiling(self):
+        # The engine events are global: statements count only for the profiler of the app that runs the request.
+        return has_request_context() and 'profile' in g and current_app._get_current_object() is self.app
+
+    # SQL
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.profiling():
+            conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if not self.profiling() or not conn.info.get('query_started'):
+            return
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        profile = g.profile
+        profile.queries += 1
+        profile.sql_time += elapsed
+        # Statements are parametrized, so the text is the same for every row of an N+1 loop.
+        profile.statements[statement] += 1
+        profile.slowest.append((elapsed, statement))
+        profile.slowest.sort(reverse=True)
+        del profile.slowest[SLOWEST_STATEMENTS:]
+
+    # Templates
+    def before_render(self, sender, template, context, **extra):
+        if 'profile' in g:
+            g.profile.render_started.append(time.perf_counter())
+
+    def after_render(self, sender, template, context, **extra):
+        if 'profile' in g and g.profile.render_started:
+            g.profile.render_time += time.perf_counter() - g.profile.render_started.pop()
+
+    # Requests
+    def start_request(self):
+        if request.endpoint == 'metrics':
+            return
+        self.start_sampler()
+        g.profile = RequestProfile()
+        self.active[threading.get_ident()] = g.profile
+
+    def teardown_request(self, exception):
+        self.active.pop(threading.get_ident(), None)
+
+    def finish_request(self, response):
+        profile = g.get('profile')
+        if profile is None:
+            return response
+        endpoint = request.endpoint or 'unknown'
+        description = '{} {}'.format(request.method, request.full_path.rstrip('?'))
+        thread_id = threading.get_ident()
+        if response.is_streamed:
+            # A streamed page (stream_page()) renders, and may query, while it is sent, after this: the header can
+            # only tell the time to the first byte, and the profile is finished once the response is closed.
+            response.headers['Server-Timing'] = server_timing(profile, 'before the body')
+            response.call_on_close(lambda: self.finish_profile(profile, endpoint, description, thread_id))
+            return response
+        g.pop('profile')
+        response.headers['Server-Timing'] = server_timing(profile)
+        self.finish_profile(profile, endpoint, description, thread_id)
+        return response
+
+    def finish_profile(self, profile, endpoint, description, thread_id):
+        # Runs after the request context is gone for streamed responses, so it is given everything it needs.
+        self.active.pop(thread_id, None)
+        duration = time.perf_counter() - profile.started
+        repeated = [(statement, count) for statement, count in profile.statements.items()
+                    if count >= self.app.config['PROFILING_REPEAT_THRESHOLD']]
+        for statement, count in repeated:
+            logger.warning('Possible N+1 in %s: statement ran %d times: %s', endpoint, count, shorten(statement))
+        slow = duration * 1000 >= self.app.config['PROFILING_SLOW_MS']
+        if slow:
+            self.log_slow_request(endpoint, description, duration, profile)
+
+        with self.lock:
+            stats = self.stats.setdefault(endpoint, EndpointStats())
+            stats.requests += 1
+            stats.duration += duration
+            for number, bucket in enumerate(BUCKETS):
+                if duration <= bucket:
+                    stats.buckets[number] += 1
+            stats.queries += profile.queries
+            stats.sql_time += profile.sql_time
+            stats.render_time += profile.render_time
+            stats.slow += slow
+            stats.n_plus_one += bool(repeated)
+
+    def log_slow_request(self, endpoint, description, duration, profile):
+        lines = ['Slow request {} ({}): {:.0f} ms, {} queries in {:.0f} ms, rendering {:.0f} ms'.format(
+            description, endpoint, duration * 1000, profile.queries, profile.sql_time * 1000,
+            profile.render_time * 1000)]
+        for elapsed, statement in profile.slowest:
+            lines.append('  {:8.1f} ms  {}'.format(elapsed * 1000, shorten(statement)))
+        total = sum(profile.samples.values())
+        for stack, count in profile.samples.most_common(3):
+            lines.append('  {}% of samples:'.format(round(100 * count / total)))
+            lines.extend('    ' + frame for frame in stack)
+        logger.warning('\n'.join(lines))
+
+    # Stack sampling
+    def start_sampler(self):
+        # One daemon thread per worker process; started lazily so that it is created after gunicorn forks.
+        if self.sampler_pid != os.getpid():
+            self.sampler_pid = os.getpid()
+            threading.Thread(target=self.sample, name='profiling-sampler', daemon=True).start()
+
+    def sample(self):
+        interval = self.app.config['PROFILING_SAMPLE_INTERVAL']
+        while True:
+            time.sleep(interval)
+            frames = sys._current_frames()
+            for thread_id, profile in list(self.active.items()):
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    profile.samples[stack_of(frame)] += 1
+
+    # /metrics
+    def metrics(self):
+        lines = []
+
+        def metric(name, kind, help, values):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.extend(values)
+
+        with self.lock:
+            stats = sorted(self.stats.items())
+            metric('tinysteps_requests_total', 'counter', 'Profiled requests.',
+                   ['tinysteps_requests_total{{endpoint="{}"}} {}'.format(e, s.requests) for e, s in stats])
+            histogram = []
+            for endpoint, s in stats:
+                for bucket, count in zip(BUCKETS, s.buckets):
+                    histogram.append('tinysteps_request_duration_seconds_bucket{{endpoint="{}",le="{}"}} {}'
+                                     .format(endpoint, bucket, count))
+                histogram.append('tinysteps_request_duration_seconds_bucket{{endpoint="{}",le="+Inf"}} {}'
+                                 .format(endpoint, s.requests))
+                histogram.append('tinysteps_request_duration_seconds_sum{{endpoint="{}"}} {:.6f}'
+                                 .format(endpoint, s.duration))
+                histogram.append('tinysteps_request_duration_seconds_count{{endpoint="{}"}} {}'
+                                 .format(endpoint, s.requests))
+            metric('tinysteps_request_duration_seconds', 'histogram', 'Request duration.', histogram)
+            metric('tinysteps_sql_queries_total', 'counter', 'SQL statements executed.',
+                   ['tinysteps_sql_queries_total{{endpoint="{}"}} {}'.format(e, s.queries) for e, s in stats])
+            metric('tinysteps_sql_seconds_total', 'counter', 'Time spent in SQL.',
+                   ['tinysteps_sql_seconds_total{{endpoint="{}"}} {:.6f}'.format(e, s.sql_time) for e, s in stats])
+            metric('tinysteps_render_seconds_total', 'counter', 'Time spent rendering templates.',
+                   ['tinysteps_render_seconds_total{{endpoint="{}"}} {:.6f}'.format(e, s.render_time)
+                    for e, s in stats])
+            metric('tinysteps_slow_requests_total', 'counter', 'Requests slower than PROFILING_SLOW_MS.',
+                   ['tinysteps_slow_requests_total{{endpoint="{}"}} {}'.format(e, s.slow) for e, s in stats])
+            metric('tinysteps_n_plus_one_requests_total', 'counter', 'Requests that repeated one statement too often.',
+                   ['tinysteps_n_plus_one_requests_total{{endpoint="{}"}} {}'.format(e, s.n_plus_one)
+                    for e, s in stats])
+        return '\n'.join(lines) + '\n', 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+def server_timing(profile, description=None):
+    total = 'app;dur={:.2f}'.format((time.perf_counter() - profile.started) * 1000)
+    if description:
+        total += ';desc="{}"'.format(description)
+    return ', '.join(['db;dur={:.2f};desc="{} queries"'.format(profile.sql_time * 1000, profile.queries),
+                      'tpl;dur={:.2f}'.format(profile.render_time * 1000),
+                      total])
+
+
+def shorten(statement, length=200):
+    statement = re.sub(r'\s+', ' ', statement).strip()
+    return statement if len(statement) <= length else statement[:length] + '...'
+
+
+def stack_of(frame):
+    # The innermost frame (where the time goes) plus the innermost frames of our own code,
+    # skipping the standard library and installed packages; innermost last, as "file:line function".
+    stack = [frame_name(frame)]
+    frame = frame.f_back
+    while frame is not None and len(stack) < SAMPLED_FRAMES:
+        filename = frame.f_code.co_filename
+        if 'site-packages' not in filename and not filename.startswith(STDLIB):
+            stack.append(frame_name(frame))
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+def frame_name(frame):
+    return '{}:{} {}'.format(os.path.basename(frame.f_code.co_filename), frame.f_lineno, frame.f_code.co_name)
@@ -0,0 +1,197 @@
+import math
+import re
+import threading
+from bisect import bisect_left
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+# Teacher search over name, about and goal names.
+# On SQLite with FTS5 the index is the teachers_fts virtual table ranked with bm25();
+# anywhere else (no FTS5, another database) an in-process inverted index is used instead. That one only sees the
+# changes made by its own process, so the app refreshes it from the database when other processes change teachers.
+# Both match every query word as a prefix of its stem, which covers Russian and English word forms
+# ("путешествий" finds "путешествия", "teaching" finds "teacher").
+# Documents are (id, name, about, goals) tuples; the app decides how to load them.
+
+# Relative weight of name, about and goals matches.
+WEIGHTS = (10.0, 1.0, 5.0)
+
+# Longest first, so "ями" is cut before "и".
+ENDINGS = sorted(['иями', 'ями', 'ами', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ией',
+                  'ый', 'ий', 'ой', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ых', 'их', 'ую', 'юю',
+                  'ов', 'ев', 'ей', 'ам', 'ям', 'ах', 'ях', 'ом', 'ем', 'ию', 'ия', 'ью',
+                  'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й',
+                  'ings', 'ing', 'ers', 'er', 'es', 'ed', 'ly', 's'], key=len, reverse=True)
+MIN_STEM = 3
+
+
+def tokenize(value):
+    return re.findall(r'\w+', (value or '').lower())
+
+
+def stem(token):
+    for ending in ENDINGS:
+        if token.endswith(ending) and len(token) - len(ending) >= MIN_STEM:
+            return token[:-len(ending)]
+    return token
+
+
+class InvertedIndex:
+    # token -> {teacher id: weight}, plus a sorted token list for prefix lookups.
+    def __init__(self):
+        self.postings = {}
+        self.documents = {}
+        self.tokens = []
+        self.tokens_dirty = False
+        self.lock = threading.Lock()
+
+    def add(self, id, name, about, goals):
+        with self.lock:
+            self._remove(id)
+            weights = {}
+            for field, weight in zip((name, about, goals), WEIGHTS):
+                for token in tokenize(field):
+                    weights[token] = weights.get(token, 0) + weight
+            for token, weight in weights.items():
+                if token not in self.postings:
+                    self.postings[token] = {}
+                    self.tokens_dirty = True
+                self.postings[token][id] = weight
+            self.documents[id] = list(weights)
+
+    def remove(self, id):
+        with self.lock:
+            self._remove(id)
+
+    def _remove(self, id):
+        for token in self.documents.pop(id, []):
+            postings = self.postings[token]
+            postings.pop(id, None)
+            if not postings:
+                del self.postings[token]
+                self.tokens_dirty = True
+
+    def search(self, words):
+        # Every word has to match; scores add up like tf-idf.
+        with self.lock:
+            if self.tokens_dirty:
+                self.tokens = sorted(self.postings)
+                self.tokens_dirty = False
+            scores = None
+            for word in words:
+                word_scores = {}
+                start = bisect_left(self.tokens, word)
+                for token in self.tokens[start:]:
+                    if not token.startswith(word):
+                        break
+                    postings = self.postings[token]
+                    idf = math.log(1 + len(self.documents) / len(postings))
+                    for id, weight in postings.items():
+                        word_scores[id] = word_scores.get(id, 0) + weight * idf
+                if scores is None:
+                    scores = word_scores
+                else:
+                    scores = {id: score + word_scores[id] for id, score in scores.items() if id in word_scores}
+                if not scores:
+                    return []
+        return sorted(scores, key=lambda id: (-scores[id], id))
+
+
+class SearchIndex:
+    def __init__(self, table='teachers_fts'):
+        self.table = table
+        self.use_fts = None
+        self.fallback = None
+
+    def create(self, connection):
+        # Creates the FTS5 table if this database can have one. True when it exists afterwards.
+        if connection.dialect.name != 'sqlite':
+            self.use_fts = False
+            return False
+        try:
+            connection.execute(text('CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(name, about, goals)'
+                                    .format(self.table)))
+            self.use_fts = True
+        except OperationalError:
+            # SQLite built without FTS5.
+            self.use_fts = False
+        return self.use_fts
+
+    def check_fts(self, connection):
+        if self.use_fts is None:
+            self.use_fts = connection.dialect.name == 'sqlite' and connection.execute(
+                text("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {'name': self.table}).scalar() > 0
+        return self.use_fts
+
+    def is_empty(self, connection):
+        # True when the FTS5 table has no documents; the in-process index is filled on first search anyway.
+        if not self.check_fts(connection):
+            return False
+        return connection.execute(text('SELECT rowid FROM {} LIMIT 1'.format(self.table))).first() is None
+
+    def rebuild(self, connection, documents):
+        if self.check_fts(connection):
+            connection.execute(text('DELETE FROM {}'.format(self.table)))
+            self._insert(connection, documents)
+        else:
+            self.fallback = InvertedIndex()
+            for document in documents:
+                self.fallback.add(*document)
+
+    def refresh(self, connection, load_documents):
+        # Builds the in-process index again, if this process has one, and swaps it in once complete.
+        if self.check_fts(connection) or self.fallback is None:
+            return
+        fallback = InvertedIndex()
+        for document in load_documents():
+            fallback.add(*document)
+        self.fallback = fallback
+
+    def update(self, connection, documents):
+        # Re-indexes the given teachers; runs inside the caller's transaction.
+        documents = list(documents)
+        if self.check_fts(connection):
+            self._delete(connection, [document[0] for document in documents])
+            self._insert(connection, documents)
+        elif self.fallback is not None:
+            for document in documents:
+                self.fallback.add(*document)
+
+    def delete(self, connection, ids):
+        if self.check_fts(connection):
+            self._delete(connection, ids)
+        elif self.fallback is not None:
+            for id in ids:
+                self.fallback.remove(id)
+
+    def search(self, connection, query, load_documents, offset=0, limit=20):
+        # Returns (ranked teacher ids for the page, total number of matches).
+        words = [stem(token) for token in tokenize(query)]
+        if not words:
+            return [], 0
+        if self.check_fts(connection):
+            match = ' '.join('"{}"*'.format(word) for word in words)
+            total = connection.execute(text('SELECT count(*) FROM {0} WHERE {0} MATCH :match'.format(self.table)),
+                                       {'match': match}).scalar()
+            rows = connection.execute(text('SELECT rowid FROM {0} WHERE {0} MATCH :match '
+                                           'ORDER BY bm25({0}, {1}, {2}, {3}) LIMIT :limit OFFSET :offset'
+                                           .format(self.table, *WEIGHTS)),
+                                      {'match': match, 'limit': limit, 'offset': offset})
+            return [row[0] for row in rows], total
+        if self.fallback is None:
+            self.rebuild(connection, load_documents())
+        ids = self.fallback.search(words)
+        return ids[offset:offset + limit], len(ids)
+
+    def _insert(self, connection, documents):
+        rows = [{'id': id, 'name': name, 'about': about, 'goals': goals or ''}
+                for id, name, about, goals in documents]
+        if rows:
+            connection.execute(text('INSERT INTO {} (rowid, name, about, goals) VALUES (:id, :name, :about, :goals)'
+                                    .format(self.table)), rows)
+
+    def _delete(self, connection, ids):
+        if ids:
+            connection.execute(text('DELETE FROM {} WHERE rowid = :id'.format(self.table)), [{'id': id} for id in ids])
@@ -0,0 +1,52 @@
+import numpy as np
+
+import availability
+
+# "Who is free on wed at 10:00 (for travel)?" without touching every teacher row.
+# For every slot of the week there is a bitset of teacher ids (bit n set = teacher n is free), and one bitset
+# per goal; a question is an AND of two bitsets. Bitsets are numpy uint8 arrays, 8 teachers a byte,
+# so 100k teachers take 12.5 KB per slot and an intersection is a single vectorized operation.
+
+
+class SlotIndex:
+    def __init__(self, teachers):
+        # teachers: iterable of (id, free_mask, goal_mask), goal_mask having bit 1 << goal id set for every goal.
+        teachers = list(teachers)
+        ids = np.array([teacher[0] for teacher in teachers], dtype=np.int64)
+        free_masks = np.array([teacher[1] or 0 for teacher in teachers], dtype=np.int64)
+        goal_masks = np.array([teacher[2] for teacher in teachers], dtype=np.int64)
+        self.size = int(ids.max()) + 1 if len(ids) else 0
+
+        self.slots = {}
+        for slot in range(len(availability.DAYS) * len(availability.TIMES)):
+            self.slots[slot] = self.bitset(ids[(free_masks >> slot) & 1 == 1])
+        self.goals = {}
+        all_goals = int(np.bitwise_or.reduce(goal_masks)) if len(ids) else 0
+        for goal_id in range(all_goals.bit_length()):
+            if all_goals >> goal_id & 1:
+                self.goals[goal_id] = self.bitset(ids[(goal_masks >> goal_id) & 1 == 1])
+
+    def bitset(self, ids):
+        present = np.zeros(self.size, dtype=bool)
+        present[ids] = True
+        return np.packbits(present, bitorder='little')
+
+    def free(self, mask, goal_id=None):
+        # Teachers free in at least one slot of the free_mask-style mask (and teaching the goal).
+        bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        for slot, slot_bits in self.slots.items():
+            if mask >> slot & 1:
+                bits |= slot_bits
+        if goal_id is not None:
+            bits &= self.goals.get(goal_id, 0)
+        return bits
+
+    def ids(self, bits):
+        # Teacher ids of a bitset, ascending.
+        return np.flatnonzero(np.unpackbits(bits, count=self.size, bitorder='little'))
+
+    def take(self, teacher_id, day, time):
+        # A booked slot is no longer free; applied in place, so the index needs no rebuild.
+        slot = availability.slot_bit(day, time).bit_length() - 1
+        if teacher_id < self.size:
+            self.slots[slot][teacher_id // 8] &= ~np.uint8(1 << teacher_id % 8)
@@ -0,0 +1,49 @@
+import logging
+import os
+import time
+
+from flask import g, request
+
+# Startup budget, as seen by a running worker: its first request is logged with how long it took and how long after
+# the app was created (or the worker was forked from a preloaded master) it came. bench/startup.py measures import,
+# create_app() and first requests in fresh processes and fails when they go over budget.
+
+logger = logging.getLogger('tinysteps.startup')
+
+# When this process was forked from the one that imported this module (a worker of a preloaded master), if it was.
+# One hook for the process rather than one per report, however many apps are created.
+forked = None
+
+
+def after_fork():
+    global forked
+    forked = time.perf_counter()
+
+
+os.register_at_fork(after_in_child=after_fork)
+
+
+class StartupReport:
+    def __init__(self, app=None):
+        self.ready = time.perf_counter()
+        # Process whose first request has been reported.
+        self.reported_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+    def start_request(self):
+        if self.reported_pid != os.getpid():
+            g.first_request_started = time.perf_counter()
+
+    def finish_request(self, response):
+        started = g.pop('first_request_started', None)
+        if started is not None and self.reported_pid != os.getpid():
+            self.reported_pid = os.getpid()
+            logger.info('Worker %d: first request %s %s took %.0f ms, %.0f ms after the app was ready',
+                        os.getpid(), request.method, request.path,
+                        (time.perf_counter() - started) * 1000, (started - max(self.ready, forked or 0)) * 1000)
+        return response
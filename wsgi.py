@@ -0,0 +1,21 @@
+import logging
+import os
+import time
+
+# WSGI entry point: gunicorn --preload wsgi:app (see Procfile).
+# With --preload the gunicorn master imports this module once and forks the workers from it, so a new worker starts with
+# the app imported and created. WARM_UP=1 also compiles the templates and builds the slot index before the fork.
+
+started = time.perf_counter()
+from app import create_app, warm_up  # noqa: E402 (imported after the clock starts on purpose)
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+if os.environ.get('WARM_UP') == '1':
+    warm_up(app)
+warmed = time.perf_counter()
+
+logging.basicConfig(level=logging.INFO)
+logging.getLogger('tinysteps.startup').info('Import %.0f ms, create_app() %.0f ms, warm-up %.0f ms',
+                                            (imported - started) * 1000, (created - imported) * 1000,
+                                            (warmed - created) * 1000)